@@ -162,7 +162,7 @@ class Waveform(ShaderScene):
         from shaderflow.audio import ShaderAudio
         from shaderflow.audio.waveform import ShaderWaveform
         self.audio = ShaderAudio(scene=self, name="iAudio", file="/path/to/audio.ogg")
-        self.waveform = ShaderWaveform(scene=self, audio=self.audio, smooth=False)
+        self.waveform = ShaderWaveform(scene=self, audio=self.audio, smooth=False, ring=True)
         self.shader.fragment = (shaders/"waveform.frag")
 
 # ---------------------------------------------------------------------------- #
@@ -194,7 +194,7 @@ class Visualizer(ShaderScene):
         from shaderflow.audio.waveform import ShaderWaveform
         from shaderflow.piano import PianoNote
         self.audio = ShaderAudio(scene=self, name="iAudio", file="/path/to/audio.opus")
-        self.waveform = ShaderWaveform(scene=self, audio=self.audio)
+        self.waveform = ShaderWaveform(scene=self, audio=self.audio, ring=True)
         self.spectrogram = ShaderSpectrogram(scene=self, length=0, audio=self.audio, smooth=False)
         self.spectrogram.from_notes(
             start=PianoNote.from_frequency(20),
@@ -68,7 +68,7 @@ void main() {
 
 
     // Waveform on top and bottom
-    vec2 wave = 0.2*texture(iWaveform, vec2(astuv.x, 0)).rg;
+    vec2 wave = 0.2*texture(iWaveform, vec2(astuv.x + iWaveformOffset, 0)).rg;
     if (1 - gluv.y < wave.x) {fragColor *= 0.8;}
     if (1 + gluv.y < wave.y) {fragColor *= 0.8;}
 }
\ No newline at end of file
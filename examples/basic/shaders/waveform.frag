@@ -4,7 +4,7 @@
 
 void main() {
     GetCamera(iCamera);
-    vec2 wave = texture(iWaveform, vec2(astuv.x, 0)).rg;
+    vec2 wave = texture(iWaveform, vec2(astuv.x + iWaveformOffset, 0)).rg;
     fragColor = vec4(vec3(0.2), 1);
 
     if (abs(gluv.y) < wave.x) {
@@ -1,3 +1,3 @@
 from .module import BrokenAudio, ShaderAudio
 from .spectrogram import ShaderSpectrogram
-from .waveform import ShaderWaveform
+from .waveform import ShaderWaveform, ShaderWaveformPeaks
@@ -6,7 +6,7 @@ import threading
 import time
 import warnings
 from collections import deque
-from collections.abc import Generator, Iterable
+from collections.abc import Iterable
 from enum import Enum
 from pathlib import Path
 from subprocess import DEVNULL
@@ -16,8 +16,9 @@ import numpy as np
 from attrs import Factory, define, field
 
 from shaderflow import logger
+from shaderflow.audio.shared import SharedAudioBuffer
 from shaderflow.dynamics import ShaderDynamics
-from shaderflow.ffmpeg import BrokenAudioReader, FFmpeg
+from shaderflow.ffmpeg import BrokenAudioFile, FFmpeg
 from shaderflow.module import ShaderModule
 
 Channels: TypeAlias = int
@@ -79,6 +80,7 @@ def root_mean_square(data) -> float:
 class AudioMode(Enum):
     Realtime = "realtime"
     File     = "file"
+    Shared   = "shared"
 
 @define(slots=False)
 class BrokenAudio:
@@ -86,13 +88,13 @@ class BrokenAudio:
     mode: AudioMode = field(default=AudioMode.Realtime, converter=AudioMode)
 
     data: np.ndarray = None
-    """Progressive audio data, shape: (channels, samples)"""
+    """Circular audio buffer, shape: (channels, samples), newest sample at `head - 1`"""
 
     dtype: np.dtype = np.float32
     """Data type of the audio samples"""
 
     tell: int = 0
-    """The number of samples read from the audio so far"""
+    """The number of samples read from the audio so far, only incremented after they are written"""
 
     def __attrs_post_init__(self):
         threading.Thread(target=self._play_thread, daemon=True).start()
@@ -101,7 +103,7 @@ class BrokenAudio:
 
     @property
     def buffer_size(self) -> Samples:
-        return int(self.samplerate*self.buffer_seconds)
+        return round(self.samplerate*self.buffer_seconds)
 
     @property
     def shape(self) -> tuple[Channels, Samples]:
@@ -110,32 +112,101 @@ class BrokenAudio:
     def create_buffer(self) -> None:
         self.data = np.zeros(self.shape, dtype=self.dtype)
 
+        # Recreate the segment on new shapes, readers must re-attach
+        if (self.shared is not None) and (self.shared.owner):
+            self.share(self.shared.name)
+
+    @property
+    def head(self) -> Samples:
+        """Physical index on the circular buffer where the next sample is written"""
+        return (self.tell % self.buffer_size)
+
     def add_data(self, data: np.ndarray) -> Optional[np.ndarray]:
         """
-        Roll the data to the left by the length of the new data; copy new data to the end
+        Copy new data at the write head of the circular buffer, wrapping around its end
         Note: Channel count must match the buffer's one
 
+        Single producer, single consumer: samples are written before `tell` is incremented,
+        so readers (which snapshot `tell` once) never see a partially written block, except
+        on the oldest samples the next write replaces, which reads return as copies
+
         Args:
             data: The new data of shape: (channels, length)
 
         Returns:
             The data that was written, if any
         """
-        data = np.array(data, dtype=self.dtype)
+        data = np.asarray(data, dtype=self.dtype)
         length = data.shape[1]
-        self.data = np.roll(self.data, -length, axis=1)
-        self.data[:, -length:] = data
+
+        # Only the newest samples fit, find where they start
+        write = data[:, -self.buffer_size:]
+        start = (self.tell + length - write.shape[1]) % self.buffer_size
+        split = min(write.shape[1], self.buffer_size - start)
+        self.data[:, start:start+split] = write[:, :split]
+        self.data[:, :write.shape[1]-split] = write[:, split:]
+
+        # Publish the new samples to readers
+        self._block = write.shape[1]
         self.tell += length
+        if (self.shared is not None) and (self.shared.owner):
+            self.shared.block = self._block
+            self.shared.tell = self.tell
         return data
 
+    _block: Samples = 0
+    """Length of the last write, assumed the size of the next one"""
+
+    def _racing(self) -> Samples:
+        """Absolute position below which samples may be replaced by the writer's next block"""
+        if (self.shared is not None) and (not self.shared.owner):
+            return (self.shared.tell - self.buffer_size + self.shared.block)
+        return (self.tell - self.buffer_size + self._block)
+
+    def _ring(self, start: Samples, end: Samples) -> np.ndarray:
+        """
+        Get samples between absolute sample positions [start, end), as a view unless the read
+        wraps around the buffer's end or overlaps the oldest samples the next write replaces,
+        which then returns a contiguous copy. Samples older than the buffer are zeros
+
+        Note: Views are overwritten once the writer laps the buffer, copy for long-term use
+        """
+        start, end = (int(start), int(end))
+
+        length = max(0, end - start)
+
+        # Samples before the buffer's oldest are gone, zero fill them
+        if (start < (oldest := self.tell - self.buffer_size)):
+            zeros = np.zeros((self.data.shape[0], min(oldest - start, length)), dtype=self.data.dtype)
+            if (end <= oldest):
+                return zeros
+            return np.concatenate((zeros, self._ring(oldest, end)), axis=1)
+
+        begin  = (start % self.buffer_size)
+        if (begin + length <= self.buffer_size):
+            view = self.data[:, begin:begin+length]
+
+            # Copy reads racing with the writer's next block
+            if (start < self._racing()):
+                return view.copy()
+            return view
+        return np.concatenate((
+            self.data[:, begin:],
+            self.data[:, :begin+length-self.buffer_size],
+        ), axis=1)
+
     def get_data_between_samples(self, start: Samples, end: Samples) -> np.ndarray:
-        return self.data[:, int(start):int(end)]
+        """Samples between (start, end) relative to the oldest sample in the buffer"""
+        oldest = (self.tell - self.buffer_size)
+        return self._ring(oldest + start, oldest + end)
 
     def get_data_between_seconds(self, start: float, end: float) -> np.ndarray:
         return self.get_data_between_samples(start*self.samplerate, end*self.samplerate)
 
     def get_last_n_samples(self, n: Samples, *, offset: Samples=0) -> np.ndarray:
-        return self.data[:, -(int(n+offset) + 1) : -(int(offset) + 1)]
+        """The newest n samples (ending `offset` samples before the write head)"""
+        tell = (self.tell - int(offset))
+        return self._ring(tell - min(int(n), self.buffer_size), tell)
 
     def get_last_n_seconds(self, n: float) -> np.ndarray:
         return self.get_last_n_samples(n*self.samplerate)
@@ -190,8 +261,7 @@ class BrokenAudio:
     # File
 
     _file: Path = None
-    _file_reader: BrokenAudioReader = None
-    _file_stream: Generator = None
+    _file_reader: BrokenAudioFile = None
 
     @property
     def file(self) -> Path:
@@ -204,13 +274,116 @@ class BrokenAudio:
         self._file = Path(value)
         if self._file and not (self._file.exists()):
             return logger.warn(f"Audio File doesn't exist ({value})")
-        self.samplerate   = FFmpeg.get_audio_samplerate(self.file)
-        self.channels     = FFmpeg.get_audio_channels(self.file)
-        self._file_reader = BrokenAudioReader(path=self.file)
-        self._file_stream = self._file_reader.stream
-        self.mode         = AudioMode.File
+
+        # Optimization: Decode the file only once
+        if (self._file_reader is None) or (self._file_reader.path != self._file):
+            self._file_reader = BrokenAudioFile(path=self.file)
+
+        self.samplerate = self._file_reader.samplerate
+        self.channels   = self._file_reader.channels
+        self.mode       = AudioMode.File
         self.close_recorder()
 
+    def seek(self, sample: Samples) -> Optional[np.ndarray]:
+        """
+        Fill the buffer from the audio file such that its newest sample is at `sample`, reading
+        only the new samples when moving slightly forward, or the whole buffer on time jumps
+
+        Returns:
+            The new samples when moving forward, None on jumps
+        """
+        if (self._file_reader is None):
+            return None
+        sample = int(sample)
+
+        # Sequential playback, continue from the head
+        if (0 <= (sample - self.tell) <= self.buffer_size):
+            return self.add_data(self._file_reader.window(self.tell, sample))
+
+        # Backwards or far jumps, rewrite everything
+        self.tell = (sample - self.buffer_size)
+        self.add_data(self._file_reader.window(self.tell, sample))
+        return None
+
+    # -------------------------------------------|
+    # Shared memory
+
+    shared: SharedAudioBuffer = None
+    """Shared memory circular buffer, either published (owner) or attached to"""
+
+    overruns: int = 0
+    """Number of times an attached reader fell behind the writer by more than the buffer"""
+
+    def share(self, name: Optional[str]=None) -> Self:
+        """
+        Publish this audio's buffer on shared memory for other processes to attach by name,
+        should be called after opening a recorder (changing its shape re-creates the segment)
+
+        Args:
+            name: Name of the segment, random if None, see `self.shared.name`
+
+        Returns:
+            Self, Fluent interface
+        """
+        self.close_shared()
+        self.shared = SharedAudioBuffer.create(
+            name=name,
+            channels=self.channels,
+            samplerate=self.samplerate,
+            size=self.buffer_size,
+            dtype=self.dtype,
+        )
+        self.shared.data[:] = self.data
+        self.shared.block = self._block
+        self.shared.tell = self.tell
+        self.data = self.shared.data
+        logger.info(f"Sharing audio buffer as ({self.shared.name})")
+        return self
+
+    def attach(self, name: str) -> Self:
+        """
+        Read the audio published by other process with `share()` with zero copies. Call `sync()`
+        before reading new data, no recorder or file is used meanwhile
+
+        Returns:
+            Self, Fluent interface
+        """
+        self.close_recorder()
+        self.close_shared()
+        self.shared = SharedAudioBuffer.attach(name, dtype=self.dtype)
+        self._samplerate = self.shared.samplerate
+        self._channels = self.shared.channels
+        self._buffer_seconds = (self.shared.size / self.shared.samplerate)
+        self.data = self.shared.data
+        self.tell = self.shared.tell
+        self.mode = AudioMode.Shared
+        logger.info(f"Attached to shared audio buffer ({name}) @ ({self.samplerate} Hz, {self.channels} channels)")
+        return self
+
+    def sync(self) -> Self:
+        """Catch up with the samples published by the shared writer, if attached"""
+        if (self.shared is None) or (self.shared.owner):
+            return self
+        tell = self.shared.tell
+        if ((tell - self.tell) > self.buffer_size):
+            self.overruns += 1
+            logger.warn(f"Shared audio reader fell behind by {tell - self.tell} samples (Overrun #{self.overruns})")
+        self.tell = tell
+        return self
+
+    def overrun(self, start: Samples) -> bool:
+        """Whether data read from absolute position `start` was since overwritten by the writer"""
+        if (self.shared is None):
+            return False
+        return (self.shared.tell - start) > self.buffer_size
+
+    def close_shared(self) -> Self:
+        if (self.shared is not None):
+            self.data = np.array(self.data)
+            self.shared.close()
+        self.shared = None
+        return self
+
     # -------------------------------------------|
     # Soundcard
 
@@ -391,10 +564,10 @@ class BrokenAudio:
 
     @property
     def duration(self) -> float:
-        if self.mode == AudioMode.Realtime:
+        if self.mode in (AudioMode.Realtime, AudioMode.Shared):
             return math.inf
         if self.mode == AudioMode.File:
-            return FFmpeg.get_audio_duration(self.file)
+            return self._file_reader.duration
 
 # ---------------------------------------------------------------------------- #
 
@@ -429,6 +602,8 @@ class ShaderAudio(BrokenAudio, ShaderModule):
 
     @property
     def duration(self) -> float:
+        if (self._file_reader is not None):
+            return self._file_reader.duration
         return FFmpeg.get_audio_duration(self.file)
 
     def setup(self):
@@ -436,23 +611,24 @@ class ShaderAudio(BrokenAudio, ShaderModule):
         if (self.final and self.scene.realtime):
             if (self.mode == AudioMode.File):
                 self.open_speaker()
-            else:
+            elif (self.mode == AudioMode.Realtime):
                 self.open_recorder()
 
+    def destroy(self) -> None:
+        self.close_shared()
+
     def ffhook(self, ffmpeg: FFmpeg) -> None:
         if (self.file is not None) and self.file.exists():
             ffmpeg.input(path=self.file)
             ffmpeg.shortest = True
 
     def update(self):
-        try:
-            if self._file_stream:
-                self._file_reader.chunk = self.scene.rdt
-                data = next(self._file_stream).T
-                self.add_data(data)
+        self.sync()
+
+        # Note: Sample accurate to the scene time, follows seeking and time scales
+        if (self.mode == AudioMode.File):
+            if (data := self.seek(self.scene.time * self.samplerate)) is not None:
                 self.play(data)
-        except StopIteration:
-            pass
 
         self.volume.target = 2 * root_mean_square(self.get_last_n_seconds(0.1)) * (2**0.5)
         self.std.target    = np.std(self.get_last_n_seconds(0.1))
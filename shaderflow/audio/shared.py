@@ -0,0 +1,111 @@
+import contextlib
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Self
+
+import numpy as np
+from attrs import define
+
+HEADER: int = 64
+"""Bytes reserved before the samples, (tell, samplerate, channels, size, block) int64s and padding"""
+
+@define(eq=False)
+class SharedAudioBuffer:
+    """
+    A circular audio buffer on shared memory, written by a single capture process and read by
+    any number of other processes attaching to it by name, without copies
+
+    The header's sample counter is monotonic and only published after the samples are written,
+    the same single-producer protocol as BrokenAudio's own buffer, but across processes
+    """
+
+    memory: SharedMemory
+    """The shared memory segment, header followed by the (channels, size) samples"""
+
+    owner: bool = False
+    """Whether this process created the segment, the only one allowed to write and unlink"""
+
+    header: np.ndarray = None
+    """View of the int64 header: (tell, samplerate, channels, size, block)"""
+
+    data: np.ndarray = None
+    """View of the circular samples buffer, shape: (channels, size)"""
+
+    def __attrs_post_init__(self):
+        self.header = np.ndarray((5,), dtype=np.int64, buffer=self.memory.buf)
+
+    def _map(self, dtype: np.dtype) -> Self:
+        self.data = np.ndarray(
+            shape=(self.channels, self.size), dtype=dtype,
+            buffer=self.memory.buf, offset=HEADER,
+        )
+        return self
+
+    @classmethod
+    def create(cls,
+        name: Optional[str]=None,
+        *,
+        channels: int,
+        samplerate: int,
+        size: int,
+        dtype: np.dtype=np.float32,
+    ) -> Self:
+        """Create a new segment, a random name is generated when None"""
+        memory = SharedMemory(name=name, create=True, size=HEADER + (channels*size*np.dtype(dtype).itemsize))
+        buffer = cls(memory=memory, owner=True)
+        buffer.header[:] = (0, samplerate, channels, size, 0)
+        return buffer._map(dtype)
+
+    @classmethod
+    def attach(cls, name: str, *, dtype: np.dtype=np.float32) -> Self:
+        """Attach to an existing segment created by another process"""
+        try:
+            memory = SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 tracks attached segments and unlinks them on exit
+            memory = SharedMemory(name=name)
+            resource_tracker.unregister(memory._name, "shared_memory")
+        return cls(memory=memory)._map(dtype)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    @property
+    def tell(self) -> int:
+        """Total number of samples published by the writer"""
+        return int(self.header[0])
+
+    @tell.setter
+    def tell(self, value: int):
+        self.header[0] = value
+
+    @property
+    def samplerate(self) -> int:
+        return int(self.header[1])
+
+    @property
+    def channels(self) -> int:
+        return int(self.header[2])
+
+    @property
+    def size(self) -> int:
+        return int(self.header[3])
+
+    @property
+    def block(self) -> int:
+        """Length of the writer's last write, readers copy samples the next one may replace"""
+        return int(self.header[4])
+
+    @block.setter
+    def block(self, value: int):
+        self.header[4] = value
+
+    def close(self) -> None:
+        """Release the views and the mapping, unlinking the segment if owner"""
+        self.header = self.data = None
+        with contextlib.suppress(BufferError):
+            self.memory.close()
+        if self.owner:
+            with contextlib.suppress(FileNotFoundError):
+                self.memory.unlink()
@@ -1,14 +1,21 @@
 import functools
 import math
+import tempfile
+import threading
 from collections.abc import Callable, Iterable
-from typing import TYPE_CHECKING, Union
+from typing import TYPE_CHECKING, Optional, Union
 
 import numpy as np
+import xxhash
 from attrs import Factory, define, field
 
+import shaderflow
 from shaderflow import logger
 from shaderflow.audio import BrokenAudio
+from shaderflow.audio.module import AudioMode
 from shaderflow.dynamics import DynamicNumber
+from shaderflow.ffmpeg import BrokenAudioFile, partial_file
+from shaderflow.fourier import BrokenFourier
 from shaderflow.module import ShaderModule
 from shaderflow.piano.notes import PianoNote
 from shaderflow.texture import ShaderTexture
@@ -18,12 +25,13 @@ if TYPE_CHECKING:
     import scipy
 
 class FourierMagnitude:
-    """Given an raw FFT, interpret the complex number as some size"""
-    def Amplitude(x: np.ndarray) -> np.ndarray:
-        return np.abs(x)
+    """Given an raw FFT, interpret the complex number as some size, optionally into a real `out`"""
+    def Amplitude(x: np.ndarray, out: np.ndarray=None) -> np.ndarray:
+        return np.abs(x, out=out)
 
-    def Power(x: np.ndarray) -> np.ndarray:
-        return (x*x.conjugate()).real
+    def Power(x: np.ndarray, out: np.ndarray=None) -> np.ndarray:
+        out = np.abs(x, out=out)
+        return np.square(out, out=out)
 
 class FourierVolume:
     """Convert the FFT into the final spectrogram's magnitude bin"""
@@ -116,7 +124,32 @@ class BrokenSpectrogram:
     """2^n FFT size, higher values, higher frequency resolution, less responsiveness"""
 
     sample_rateio: int = field(default=1, converter=int)
-    """Resample the input data by a factor, int for FFT optimizations"""
+    """Upsample the input data by an integer factor, band-limited, done in the frequency domain"""
+
+    resolutions: Optional[tuple[int, int]] = None
+    """
+    Multi-resolution (min, max) range of 2^n FFT sizes, each spectrogram bin is taken from the
+    smallest FFT that resolves it from its neighbors: sharp bass and responsive treble. None
+    for a single `fft_n` size for all bins, which is also the level reference for all sizes
+    """
+
+    hop: Optional[int] = None
+    """
+    Compute spectra only at fixed audio positions every this many samples, independent of the
+    framerate, each reused across frames and interpolated to the audio head one hop behind.
+    None to compute a new spectrum on every call
+    """
+
+    _hops: dict[int, np.ndarray] = Factory(dict)
+    """Spectrogram bins computed at hop-aligned audio positions"""
+
+    _hops_hash: int = None
+
+    fourier: BrokenFourier = Factory(BrokenFourier)
+    """Backend computing the FFTs, fastest available by default"""
+
+    _buffers: dict[tuple, np.ndarray] = Factory(dict)
+    """Preallocated arrays reused across calls, by purpose and shape"""
 
     # Spectrogram properties
     scale:  tuple[callable] = SpectrogramScale.Octave
@@ -132,6 +165,10 @@ class BrokenSpectrogram:
             self.maximum_frequency,
             self.spectrogram_bins,
             self.sample_rateio,
+            self.resolutions,
+            self.hop,
+            self.audio.samplerate,
+            self.window,
             self.magnitude,
             self.interpolation,
             self.scale,
@@ -152,33 +189,156 @@ class BrokenSpectrogram:
     def fft_frequencies(self) -> Union[np.ndarray, float]:
         return np.fft.rfftfreq(self.fft_size, 1/(self.audio.samplerate*self.sample_rateio))
 
-    def fft(self) -> np.ndarray:
-        data = self.audio.get_last_n_samples(int(2**self.fft_n))
+    @property
+    def fft_sizes(self) -> tuple[int]:
+        """All the 2^n FFT exponents used by at least one spectrogram bin"""
+        return tuple(np.unique(self.bin_resolutions()).tolist())
+
+    @functools.lru_cache
+    def bin_resolutions(self) -> np.ndarray:
+        """The 2^n FFT exponent assigned to each spectrogram bin"""
+        if (self.resolutions is None):
+            return np.full(self.spectrogram_bins, self.fft_n)
+
+        # Smallest FFT whose frequency step is finer than the distance between bins
+        sizes = np.arange(min(self.resolutions), max(self.resolutions) + 1)
+        steps = (self.audio.samplerate / 2.0**sizes)
+        spacing = np.abs(np.gradient(self.spectrogram_frequencies))
+        resolves = (steps[None, :] <= spacing[:, None])
+        return np.where(resolves.any(axis=1), sizes[resolves.argmax(axis=1)], sizes[-1])
+
+    def _buffer(self, *key, shape: tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        """A zero-initialized array allocated only once per key, shape and dtype"""
+        key = (*key, tuple(shape), np.dtype(dtype))
+        if (buffer := self._buffers.get(key)) is None:
+            buffer = self._buffers[key] = np.zeros(shape, dtype=dtype)
+        return buffer
+
+    def _window(self, size: int) -> np.ndarray:
+        """The window of a size, levels matched to the `fft_n` one's, in the audio's dtype"""
+        key = ("window", size, self.fft_size, self.window, np.dtype(self.audio.dtype))
+        if (window := self._buffers.get(key)) is None:
+            window = self.window(size)
+            if (size != self.fft_size):
+                window = window * (self.window(self.fft_size).sum() / window.sum())
+            window = self._buffers[key] = window.astype(self.audio.dtype)
+        return window
+
+    def spectrum(self, data: np.ndarray, *, reuse: bool=True) -> np.ndarray:
+        """
+        Windowed FFT magnitudes of (..., size) data, levels matched to the `fft_n` window's
+
+        Band-limited upsampling by an integer ratio keeps the same bins (times the ratio, taken
+        by the window's level matching) below the original Nyquist and only zeros above it, so
+        it's done directly on the spectrum, without resampling nor state across calls
+
+        Args:
+            reuse: Compute in preallocated buffers, the returned array is overwritten next call
+
+        Returns:
+            Magnitudes in the audio's dtype, shape: (..., size*sample_rateio/2 + 1)
+        """
+        size  = data.shape[-1]
+        dtype = np.dtype(self.audio.dtype)
+        shape = (*data.shape[:-1], size*self.sample_rateio//2 + 1)
+
+        # Single precision data stays complex64 on the FFT
+        if reuse:
+            windowed = self._buffer("windowed", shape=data.shape, dtype=dtype)
+            fourier  = self._buffer("fourier", shape=(*data.shape[:-1], size//2 + 1),
+                dtype=np.result_type(dtype, np.complex64))
+            output   = self._buffer("spectrum", shape=shape, dtype=dtype)
+        else:
+            windowed = fourier = None
+            output   = np.zeros(shape, dtype=dtype)
 
-        # Optionally resample the data
-        if self.sample_rateio != 1:
-            try:
-                import samplerate
-            except ModuleNotFoundError:
-                raise RuntimeError('\n'.join((
-                    "Please install 'samplerate' dependency for resampling:"
-                    "• Find it at: (https://pypi.org/project/samplerate)"
-                )))
-            data = np.array([samplerate.resample(x, self.sample_rateio, 'linear') for x in data])
+        windowed = np.multiply(self._window(size), data, out=windowed)
+        fourier  = self.fourier.rfft(windowed, out=fourier)
+
+        # Only the built-in magnitudes are known to take an `out=`
+        if (self.magnitude in vars(FourierMagnitude).values()):
+            self.magnitude(fourier, out=output[..., :size//2 + 1])
+        else:
+            output[..., :size//2 + 1] = self.magnitude(fourier)
+        return output
 
-        return self.magnitude(
-            np.fft.rfft(self.window(self.fft_size) * data)
-        ).astype(self.audio.dtype)
+    def fft(self, fft_n: Optional[int]=None, *, offset: int=0) -> np.ndarray:
+        return self.spectrum(self.audio.get_last_n_samples(int(2**(fft_n or self.fft_n)), offset=offset))
+
+    def batched(self, file: BrokenAudioFile, positions: np.ndarray) -> np.ndarray:
+        """
+        Vectorized spectrogram of many windows of an audio file, each ending at a sample position,
+        same as `next()` with the audio's head at each of them, in a single FFT and matmul
+
+        Returns:
+            Spectrogram bins of each position, shape: (len(positions), channels, bins)
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if (not self.hop):
+            return self._batched(file, positions)
+
+        # Same interpolation as `hopped()`, each hop-aligned spectrum computed once
+        starts = ((positions - self.hop) // self.hop) * self.hop
+        hops   = np.unique(np.concatenate((starts, starts + self.hop)))
+        bins   = self._batched(file, hops)
+        lower  = np.searchsorted(hops, starts)
+        ratio  = ((positions - self.hop - starts) / self.hop)[:, None, None]
+        return (1 - ratio)*bins[lower] + ratio*bins[lower + 1]
+
+    def _batched(self, file: BrokenAudioFile, positions: np.ndarray) -> np.ndarray:
+        start = int(positions[0]) - int(2**max(self.fft_sizes))
+        chunk = file.window(start, int(positions[-1]))
+        bins  = 0
+
+        for fft_n in self.fft_sizes:
+            size = int(2**fft_n)
+
+            # Strided (channels, windows, size) view, picking a copy of the wanted ones
+            frames = np.lib.stride_tricks.sliding_window_view(chunk, size, axis=1)
+            frames = frames[:, np.asarray(positions) - start - size].transpose(1, 0, 2)
+            fft = self.spectrum(frames, reuse=False)
+            bins = bins + self.spectrogram_matrix(fft_n).dot(fft.reshape(-1, fft.shape[-1]).T).T
+
+        return bins.reshape(len(positions), file.channels, -1)
 
     # # Spectrogram
 
     def next(self) -> np.ndarray:
-        return self.spectrogram_matrix().dot(self.fft().T).T
+        if self.hop:
+            return self.hopped()
+        return self.bins()
+
+    def bins(self, *, offset: int=0) -> np.ndarray:
+        """Spectrogram bins of the audio ending `offset` samples before its head"""
+        return sum(
+            self.spectrogram_matrix(fft_n).dot(self.fft(fft_n, offset=offset).T)
+            for fft_n in self.fft_sizes
+        ).T
         return self.volume([
             self.spectrogram_matrix() @ channel
             for channel in self.fft()
         ])
 
+    def hopped(self) -> np.ndarray:
+        """Spectrogram bins interpolated between the two latest hop-aligned spectra"""
+        tell  = self.audio.tell
+        start = (((tell - self.hop) // self.hop) * self.hop)
+
+        # Parameters changed or audio went back in time, cached spectra are stale
+        if (self._hops_hash != hash(self)) or any(position > tell for position in self._hops):
+            self._hops_hash = hash(self)
+            self._hops.clear()
+
+        for position in (start, start + self.hop):
+            if position not in self._hops:
+                self._hops[position] = self.bins(offset=(tell - position))
+
+        for position in [position for position in self._hops if position < start]:
+            del self._hops[position]
+
+        ratio = (tell - self.hop - start) / self.hop
+        return (1 - ratio)*self._hops[start] + ratio*self._hops[start + self.hop]
+
     minimum_frequency: float = 20.0
     maximum_frequency: float = 20000.0
     spectrogram_bins:  int   = 1000
@@ -192,7 +352,7 @@ class BrokenSpectrogram:
         ))
 
     @functools.lru_cache
-    def spectrogram_matrix(self) -> Union[np.ndarray, 'scipy.sparse.csr_matrix']:
+    def spectrogram_matrix(self, fft_n: Optional[int]=None) -> Union[np.ndarray, 'scipy.sparse.csr_matrix']:
         """
         Gets a transformation matrix that multiplied with self.fft yields "spectrogram bins" in custom scale
 
@@ -204,23 +364,56 @@ class BrokenSpectrogram:
         And then create many band-pass filters, each one centered on the center frequencies using
         Whittaker-Shannon's interpolation formula per row of the matrix, considering the FFT bins as
         a one-hertz-frequency function to interpolate, we find "the around frequencies" !
-        """
-
-        # Whittaker-Shannon interpolation formula per row of the matrix
-        matrix = np.array([
-            self.interpolation(index - np.arange(self.fft_bins))
-            for index in (self.spectrogram_frequencies/self.fft_frequencies[1])
-        ], dtype=self.audio.dtype)
 
-        # Zero out near-zero values
-        matrix[np.abs(matrix) < 1e-5] = 0
+        For multi-resolution, only the rows of bins assigned to the 2^fft_n size are non-zero
+        """
+        fft_n    = (fft_n or self.fft_n)
+        fft_size = int(2**fft_n * self.sample_rateio)
+        fft_bins = (fft_size//2 + 1)
+        rows     = (self.bin_resolutions() == fft_n)
+
+        centers = (self.spectrogram_frequencies / (self.audio.samplerate*self.sample_rateio/fft_size))
+        shape   = (self.spectrogram_bins, fft_bins)
+
+        # Support of the kernel, the furthest distance it's not a near-zero value
+        probe  = np.arange(0, fft_bins + 1, 0.25)
+        kernel = np.abs(self.interpolation(probe)) + np.abs(self.interpolation(-probe))
+        radius = int(math.ceil(probe[np.flatnonzero(kernel >= 1e-5)].max(initial=0))) + 1
+
+        # Kernels are keyed by their values, as hashes of callables aren't stable across runs
+        key = xxhash.xxh3_128()
+        for part in (centers, kernel, rows, np.array(shape), np.dtype(self.audio.dtype).str.encode()):
+            key.update(part)
+        cache = (shaderflow.directories.user_cache_path/"spectrogram"/f"{key.hexdigest()}.npz")
+
+        if cache.exists():
+            with np.load(cache) as file:
+                data, indices, indptr = (file["data"], file["indices"], file["indptr"])
+        else:
+            # Whittaker-Shannon interpolation formula only within each row's support window
+            width   = min(2*radius + 1, fft_bins)
+            start   = np.clip(np.floor(centers).astype(np.int64) - radius, 0, fft_bins - width)
+            columns = (start[:, None] + np.arange(width))
+            values  = self.interpolation(centers[:, None] - columns).astype(self.audio.dtype)
+
+            # Drop near-zero values, rows are already sorted for CSR
+            keep    = (np.abs(values) >= 1e-5) & rows[:, None]
+            data    = values[keep]
+            indices = columns[keep].astype(np.int32)
+            indptr  = np.concatenate(([0], np.cumsum(keep.sum(axis=1)))).astype(np.int32)
+
+            # Note: A file object, as savez appends an .npz suffix to paths
+            with partial_file(cache) as partial, open(partial, "wb") as file:
+                np.savez(file, data=data, indices=indices, indptr=indptr)
 
         try:
             import scipy
-            matrix = scipy.sparse.csr_matrix(matrix)
+            return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
         except ModuleNotFoundError:
             logger.tip("Consider installing scipy for faster spectrogram sparse matrix multiplications")
 
+        matrix = np.zeros(shape, dtype=self.audio.dtype)
+        matrix[np.repeat(np.arange(shape[0]), np.diff(indptr)), indices] = data
         return matrix
 
     def from_notes(self,
@@ -246,6 +439,69 @@ class BrokenSpectrogram:
 
 # ---------------------------------------------------------------------------- #
 
+@define(eq=False)
+class OfflineSpectrogram:
+    """
+    Whole spectrogram of an audio file at known sample positions, computed ahead of the renderer
+    on a worker thread in large vectorized batches, memory mapped to a temporary file
+    """
+    spectrogram: BrokenSpectrogram
+    file: BrokenAudioFile
+
+    positions: np.ndarray
+    """Sorted audio head positions (sample count) of each frame"""
+
+    batch: int = 256
+    """Number of frames computed at once"""
+
+    data: np.ndarray = None
+    """Memory mapped results, shape: (frames, channels, bins)"""
+
+    ready: int = 0
+    """Number of frames computed so far"""
+
+    failed: bool = False
+    condition: threading.Condition = Factory(threading.Condition)
+
+    _hash: int = None
+    """Spectrogram parameters the results are valid for"""
+
+    def __attrs_post_init__(self):
+        self._hash = hash(self.spectrogram)
+        self.data = np.memmap(
+            filename=tempfile.TemporaryFile(),
+            shape=(len(self.positions), self.file.channels, self.spectrogram.spectrogram_bins),
+            dtype=np.float32, mode="w+",
+        )
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self) -> None:
+        try:
+            for start in range(0, len(self.positions), self.batch):
+                positions = self.positions[start:start+self.batch]
+                self.data[start:start+len(positions)] = self.spectrogram.batched(self.file, positions)
+                with self.condition:
+                    self.ready = (start + len(positions))
+                    self.condition.notify_all()
+        except Exception as error:
+            logger.error(f"Offline spectrogram failed, computing per frame: {error}")
+            with self.condition:
+                self.failed = True
+                self.condition.notify_all()
+
+    def get(self, tell: int) -> Optional[np.ndarray]:
+        """Precomputed bins for the audio's head at `tell` (within a sample), waits the worker"""
+        if self.failed or (self._hash != hash(self.spectrogram)):
+            return None
+        index = int(np.searchsorted(self.positions, tell - 1))
+        if (index >= len(self.positions)) or (abs(int(self.positions[index]) - tell) > 1):
+            return None
+        with self.condition:
+            self.condition.wait_for(lambda: self.failed or (self.ready > index))
+        return (None if self.failed else self.data[index])
+
+# ---------------------------------------------------------------------------- #
+
 @define(eq=False)
 class ShaderSpectrogram(BrokenSpectrogram, ShaderModule):
     name: str = "iSpectrogram"
@@ -269,6 +525,14 @@ class ShaderSpectrogram(BrokenSpectrogram, ShaderModule):
     texture: ShaderTexture = None
     """Internal managed Texture"""
 
+    offline: bool = True
+    """Precompute the whole spectrogram ahead in batches when exporting audio files"""
+
+    _precomputed: OfflineSpectrogram = None
+
+    _targets: list[np.ndarray] = None
+    """Two preallocated dynamics targets alternated each frame, as it keeps the previous one"""
+
     @property
     def length_samples(self) -> int:
         return int(max(1, self.length*self.scene.fps))
@@ -295,19 +559,51 @@ class ShaderSpectrogram(BrokenSpectrogram, ShaderModule):
             repeat_y=False,
         )
 
+    def setup(self):
+        self._precomputed = None
+
+    def _make_offline(self) -> Optional[OfflineSpectrogram]:
+        if not (self.offline and self.scene.freewheel):
+            return None
+        if (self.audio.mode != AudioMode.File) or (self.scene.speed <= 0):
+            return None
+
+        # Audio head positions the scene will seek to on each frame
+        frames = round(self.scene.runtime * self.scene.fps) + 1
+        seconds = self.scene.time + np.arange(frames) * (self.scene.speed / self.scene.fps)
+        self.log_info(f"Precomputing spectrogram of {frames} frames ahead")
+        return OfflineSpectrogram(
+            spectrogram=self,
+            file=self.audio._file_reader,
+            positions=(seconds * self.audio.samplerate).astype(int),
+        )
+
+    def _next(self) -> np.ndarray:
+        if (self._precomputed is None):
+            self._precomputed = (self._make_offline() or False)
+        if self._precomputed and ((bins := self._precomputed.get(self.audio.tell)) is not None):
+            return bins
+        return self.next()
+
     def update(self):
         self.texture.components = self.audio.channels
         self.texture.filter = ("linear" if self.smooth else "nearest")
         self.texture.height = self.spectrogram_bins
         self.texture.width = self.length_samples
         self.offset = (self.offset + 1) % self.length_samples
-        if (self.dynamics.value.shape != (self._row_shape)):
+        if (self._targets is None) or (self.dynamics.value.shape != (self._row_shape)):
             self.dynamics.set(self._row_zeros)
-        self.dynamics.target = self.next().T.reshape(2, -1)
+            self._targets = [self._row_zeros, self._row_zeros]
+
+        # Interleave channels per bin, the texture's layout, into the older target
+        self._targets.reverse()
+        target = self._targets[0]
+        target.reshape(self.spectrogram_bins, -1)[:] = self._next().T
+        self.dynamics.target = target
         self.dynamics.next(dt=abs(self.scene.dt))
         self.texture.write(
             viewport=(self.offset, 0, 1, self.spectrogram_bins),
-            data=self.dynamics.value.astype(np.float32),
+            data=np.asarray(self.dynamics.value, dtype=np.float32),
         )
 
     def pipeline(self) -> Iterable[ShaderVariable]:
@@ -1,11 +1,15 @@
 import math
 from collections.abc import Iterable
 from enum import Enum
+from typing import Optional
 
 import numpy as np
-from attrs import define
+from attrs import Factory, define
 
+from shaderflow import logger
 from shaderflow.audio import BrokenAudio
+from shaderflow.audio.module import AudioMode
+from shaderflow.ffmpeg import BrokenAudioFile, partial_file
 from shaderflow.module import ShaderModule
 from shaderflow.texture import ShaderTexture
 from shaderflow.variable import ShaderVariable, Uniform
@@ -45,6 +49,22 @@ class ShaderWaveform(ShaderModule):
     texture: ShaderTexture = None
     """Internal managed Texture"""
 
+    ring: bool = False
+    """
+    Upload only the new chunks' columns to a texture used as a ring, written at each chunk's
+    index, instead of the whole texture in time order. Shaders must then sample the texture at
+    `x + {name}Offset`, as it repeats on X
+    """
+
+    offset: int = 0
+    """Column of the oldest chunk if `ring`, else always zero"""
+
+    _reduced: np.ndarray = None
+    """Reduced values of the last chunks, the texture's contents, shape (points, channels)"""
+
+    _chunks: int = None
+    """Index of the next chunk to be reduced, counted from the audio's start"""
+
     @property
     def length_samples(self) -> int:
         return int(max(1, self.length*self.scene.fps))
@@ -59,7 +79,9 @@ class ShaderWaveform(ShaderModule):
             height=1,
             mipmaps=False,
             dtype=np.float32,
-        ).repeat(False)
+            repeat_x=self.ring,
+            repeat_y=False,
+        )
 
     @property
     def chunk_size(self) -> int:
@@ -67,7 +89,7 @@ class ShaderWaveform(ShaderModule):
 
     @property
     def _points(self) -> int:
-        return self.length*self.samplerate
+        return int(self.length*self.samplerate)
 
     @property
     def _offset(self) -> int:
@@ -77,14 +99,243 @@ class ShaderWaveform(ShaderModule):
     def _cutoff(self) -> int:
         return int(self.chunk_size * math.floor(self.audio.buffer_size/self.chunk_size))
 
+    def _write(self, start: int, stop: int) -> None:
+        """Upload the ring's columns of chunks [start, stop), split where it wraps around"""
+        column = (start % self._points)
+        first  = min(self._points - column, stop - start)
+        for column, width in ((column, first), (0, stop - start - first)):
+            if (width > 0):
+                self.texture.write(
+                    data=self._reduced[column:column+width],
+                    viewport=(column, 0, width, 1),
+                )
+
+    def update(self):
+        points, channels = (self._points, self.audio.channels)
+
+        # Reset on parameters changes
+        if (self._reduced is None) or (self._reduced.shape != (points, channels)) \
+            or (self.texture.repeat_x != self.ring):
+            self._reduced = np.zeros((points, channels), dtype=np.float32)
+            self.texture.components = channels
+            self.texture.width = points
+            self.texture.repeat_x = self.ring
+            self._chunks = None
+
+        # Only reduce complete chunks that arrived since last time, all on seeks
+        chunks = (self.audio.tell // self.chunk_size)
+        if (self._chunks is None) or not (0 <= (chunks - self._chunks) <= points):
+            self._chunks = (chunks - points)
+        if (new := chunks - self._chunks) > 0:
+            data = self.audio.get_last_n_samples(self.chunk_size*new, offset=self._offset)
+            data = self.reducer(data.reshape(channels, new, self.chunk_size))
+            self._reduced[np.arange(self._chunks, chunks) % points] = data.T
+            if self.ring:
+                self._write(self._chunks, chunks)
+            else:
+                self.texture.write(np.roll(self._reduced, -(chunks % points), axis=0))
+            self._chunks = chunks
+        self.offset = (chunks % points) if self.ring else 0
+
+    def pipeline(self) -> Iterable[ShaderVariable]:
+        yield Uniform("int",   f"{self.name}Length", self.length_samples)
+        yield Uniform("float", f"{self.name}Offset", self.offset/self._points)
+
+# ---------------------------------------------------------------------------- #
+
+@define(eq=False)
+class BrokenAudioPeaks:
+    """
+    A pyramid of (min, max, mean square) summaries of a whole audio file, as audio editors do:
+    the first level summarizes blocks of `base` samples, each next one `factor` blocks of the
+    previous. Any window is served at any zoom in O(columns) from the coarsest level finer than
+    a fraction of a column, instead of reducing all its raw samples
+
+    Built once per file and memory mapped from the decoded audio's cache directory
+    """
+    file: BrokenAudioFile
+
+    base: int = 256
+    """Samples summarized by each block of the first level"""
+
+    factor: int = 4
+    """Blocks of a level summarized by each block of the next"""
+
+    precision: int = 4
+    """Minimum blocks per column, bounds the error at the columns' edges to 1/precision of them"""
+
+    levels: list[np.ndarray] = Factory(list)
+    """Memory mapped summaries of each level, shape: (blocks, channels, 3)"""
+
+    def __attrs_post_init__(self):
+        self.load()
+
+    def block(self, level: int) -> int:
+        """Number of samples summarized by each block of a level"""
+        return self.base * (self.factor ** level)
+
+    @property
+    def sizes(self) -> list[int]:
+        sizes = [max(1, math.ceil(self.file.samples / self.base))]
+        while (sizes[-1] > 1):
+            sizes.append(math.ceil(sizes[-1] / self.factor))
+        return sizes
+
+    def load(self) -> None:
+        cache = self.file.cache.with_suffix(f".{self.base}x{self.factor}.peaks")
+        shape = (sum(self.sizes), self.file.channels, 3)
+
+        if not cache.exists():
+            logger.info(f"Building waveform peaks of ({self.file.path})")
+            with partial_file(cache) as partial:
+                peaks = np.memmap(partial, dtype=np.float32, mode="w+", shape=shape)
+                self._build(peaks)
+                peaks.flush()
+
+        data = np.memmap(cache, dtype=np.float32, mode="r", shape=shape)
+        offsets = np.cumsum([0] + self.sizes)
+        self.levels = [data[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def _build(self, data: np.memmap) -> None:
+        sizes = self.sizes
+        first = data[:sizes[0]]
+        first[:] = 0
+
+        # The first level from the raw samples, in chunks of whole blocks
+        chunk = (self.base * 2**12)
+        for start in range(0, self.file.samples, chunk):
+            samples = self.file.data[start:start+chunk]
+            index = np.arange(0, len(samples), self.base)
+            blocks = slice(start//self.base, start//self.base + len(index))
+            counts = np.diff(np.append(index, len(samples)))[:, None]
+            first[blocks, :, 0] = np.minimum.reduceat(samples, index, axis=0)
+            first[blocks, :, 1] = np.maximum.reduceat(samples, index, axis=0)
+            first[blocks, :, 2] = np.add.reduceat(np.square(samples), index, axis=0) / counts
+
+        # Each next level from the previous one, small enough to do at once
+        offset = 0
+        for previous, size in zip(sizes, sizes[1:]):
+            lower  = data[offset:offset+previous]
+            upper  = data[offset+previous:offset+previous+size]
+            index  = np.arange(0, previous, self.factor)
+            counts = np.diff(np.append(index, previous))[:, None]
+            upper[:, :, 0] = np.minimum.reduceat(lower[:, :, 0], index, axis=0)
+            upper[:, :, 1] = np.maximum.reduceat(lower[:, :, 1], index, axis=0)
+            upper[:, :, 2] = np.add.reduceat(lower[:, :, 2], index, axis=0) / counts
+            offset += previous
+        data.flush()
+
+    def query(self, start: int, end: int, columns: int) -> np.ndarray:
+        """
+        Summaries of `columns` equal parts of the samples [start, end), zeros outside the file
+
+        Returns:
+            (min, max, rms) of each column and channel, shape: (columns, channels, 3)
+        """
+        result = np.zeros((columns, self.file.channels, 3), dtype=np.float32)
+        span   = (end - start) / columns
+
+        # Coarsest level with enough blocks per column, raw samples when zoomed in
+        fraction = (span / self.precision)
+        level = int(math.floor(math.log(fraction/self.base, self.factor))) if (fraction >= self.base) else -1
+        level = min(level, len(self.levels) - 1)
+        if (level < 0):
+            size, origin = (1, max(0, start))
+            samples = self.file.data[origin:max(origin, min(end, self.file.samples))]
+            lows = highs = samples
+        else:
+            size, origin = (self.block(level), 0)
+            summary = self.levels[level]
+            lows, highs, samples = (summary[:, :, 0], summary[:, :, 1], summary[:, :, 2])
+
+        # Block boundaries of each column, empty ones are outside the file
+        edges = np.clip(start + span*np.arange(columns + 1), 0, self.file.samples)
+        index = np.clip(((edges - origin) // size).astype(np.int64), 0, len(samples))
+        valid = (index[:-1] < index[1:])
+        if not valid.any():
+            return result
+
+        starts = index[:-1][valid]
+        stop   = index[1:][valid][-1]
+        counts = np.diff(np.append(starts, stop))[:, None]
+        square = (np.square(samples[:stop]) if (level < 0) else samples[:stop])
+        result[valid, :, 0] = np.minimum.reduceat(lows[:stop], starts, axis=0)
+        result[valid, :, 1] = np.maximum.reduceat(highs[:stop], starts, axis=0)
+        result[valid, :, 2] = np.sqrt(np.add.reduceat(square, starts, axis=0) / counts)
+        return result
+
+# ---------------------------------------------------------------------------- #
+
+@define
+class ShaderWaveformPeaks(ShaderModule):
+    """
+    Overview waveform of a whole audio file or any window of it, from its peaks pyramid. Each
+    row is a channel, each pixel is the (min, max, rms) of a column. Only updated when the window
+    changes, so static overviews cost nothing per frame
+    """
+
+    name: str = "iPeaks"
+    """Prefix name and Texture name of the Shader Variables"""
+
+    audio: BrokenAudio = None
+    """Audio to summarize, must be playing a file"""
+
+    points: int = 1024
+    """Number of columns of the texture"""
+
+    length: Optional[float] = None
+    """Seconds shown, the whole file when None"""
+
+    follow: bool = False
+    """Center the window on the playhead, else start it at the file's beginning"""
+
+    texture: ShaderTexture = None
+    """Internal managed Texture"""
+
+    peaks: BrokenAudioPeaks = None
+    """Peaks pyramid of the audio's file, rebuilt when it changes"""
+
+    _window: tuple[int, int, int] = None
+    """The uploaded (start, end, points), skips redundant updates"""
+
+    def build(self):
+        self.texture = ShaderTexture(
+            scene=self.scene,
+            name=self.name,
+            components=3,
+            height=1,
+            width=self.points,
+            mipmaps=False,
+            dtype=np.float32,
+            repeat_y=False,
+        ).repeat(False)
+
+    @property
+    def window(self) -> tuple[int, int]:
+        """The (start, end) samples shown"""
+        file = self.audio._file_reader
+        if (self.length is None):
+            return (0, file.samples)
+        length = int(self.length * file.samplerate)
+        if self.follow:
+            return (self.audio.tell - length//2, self.audio.tell + length - length//2)
+        return (0, length)
+
     def update(self):
-        start  = -int(self.chunk_size*self._points + self._offset + 1)
-        end    = -int(self._offset + 1)
-        chunks = self.audio.data[:, start:end]
-        chunks = chunks.reshape(self.audio.channels, -1, self.chunk_size)
-        chunks = self.reducer(chunks)
-        chunks = np.ascontiguousarray(chunks.T)
-        self.texture.write(chunks)
+        if (self.audio.mode != AudioMode.File) or (self.audio._file_reader is None):
+            return None
+        if (self.peaks is None) or (self.peaks.file is not self.audio._file_reader):
+            self.peaks = BrokenAudioPeaks(file=self.audio._file_reader)
+            self._window = None
+        if (window := (*self.window, self.points)) == self._window:
+            return None
+        self.texture.width  = self.points
+        self.texture.height = self.peaks.file.channels
+        self.texture.write(np.ascontiguousarray(self.peaks.query(*window).swapaxes(0, 1)))
+        self._window = window
 
     def pipeline(self) -> Iterable[ShaderVariable]:
-        yield Uniform("int", f"{self.name}Length", self.length_samples)
+        start, end = (self._window or (0, 1, 0))[:2]
+        head = ((self.audio.tell - start) / max(1, end - start))
+        yield Uniform("int",   f"{self.name}Points", self.points)
+        yield Uniform("float", f"{self.name}Head",   head)
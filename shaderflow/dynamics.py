@@ -1,18 +1,22 @@
 from __future__ import annotations
 
+import cmath
 import math
 from collections.abc import Iterable
 from copy import deepcopy
 from math import pi, tau
 from numbers import Number
-from typing import Optional, Self, TypeAlias, Union
+from typing import TYPE_CHECKING, ClassVar, Optional, Self, TypeAlias, Union
 
 import numpy as np
-from attrs import define, field
+from attrs import Factory, define, field
 
 from shaderflow.module import ShaderModule
 from shaderflow.variable import ShaderVariable, Uniform
 
+if TYPE_CHECKING:
+    from shaderflow.scene import ShaderScene
+
 # Fixme: Move to Broken when ought to be used somewhere else?
 
 DynType: TypeAlias = np.ndarray
@@ -136,20 +140,27 @@ class DynamicNumber(NumberDunder, Number):
 
     # # Dynamics system parameters
 
-    frequency: float = 1.0
+    revision: ClassVar[int] = 0
+    """Incremented whenever any system's parameters change, invalidating packed copies of them"""
+
+    def _parameter_setattr(self, attribute, value):
+        DynamicNumber.revision += 1
+        return value
+
+    frequency: float = field(default=1.0, on_setattr=_parameter_setattr)
     """Natural frequency of the system in Hertz, "the speed the system responds to a change in input".
     Also, the frequency it tends to vibrate at, doesn't affect shape of the resulting motion"""
 
-    zeta: float = 1.0
+    zeta: float = field(default=1.0, on_setattr=_parameter_setattr)
     """Damping coefficient, z=0 vibration never dies, z=1 is the critical limit where the system
     does not overshoot, z>1 increases this effect and the system takes longer to settle"""
 
-    response: float = 0.0
+    response: float = field(default=0.0, on_setattr=_parameter_setattr)
     """Defines the initial response "time" of the system, when r=1 the system responds instantly
     to changes on the input, when r=0 the system takes a bit to respond (smoothstep like), when r<0
     the system "anticipates" motion"""
 
-    precision: float = 1e-6
+    precision: float = field(default=1e-6, on_setattr=_parameter_setattr)
     """If `max(target - value) < precision`, the system stops updating to save computation"""
 
     # # Auxiliary intrinsic variables
@@ -157,7 +168,7 @@ class DynamicNumber(NumberDunder, Number):
     integral: DynType = 0.0
     """Integral of the system, the sum of all values over time"""
 
-    integrate: bool = False
+    integrate: bool = field(default=False, on_setattr=_parameter_setattr)
     """Whether to integrate the system's value over time"""
 
     derivative: DynType = 0.0
@@ -194,10 +205,30 @@ class DynamicNumber(NumberDunder, Number):
         """Damping ratio of some sort"""
         return self.radians * (abs(self.zeta*self.zeta - 1.0))**0.5
 
+    def coefficients(self, dt: float) -> tuple[float, float]:
+        """The stable (k1, k2) coefficients for a time step"""
+
+        # "Clamp k2 to stable values without jitter"
+        if (self.radians*dt < self.zeta):
+            k1 = self.k1
+            k2 = max(k1*dt, self.k2, 0.5*(k1+dt)*dt)
+
+        # "Use pole matching when the system is very fast"
+        else:
+            t1 = math.exp(-1 * self.zeta * self.radians * dt)
+            a1 = 2 * t1 * (math.cos if self.zeta <= 1 else math.cosh)(self.damping*dt)
+            t2 = 1/(1 + t1*t1 - a1) * dt
+            k1 = t2 * (1 - t1*t1)
+            k2 = t2 * dt
+
+        return (k1, k2)
+
     def next(self, target: Optional[DynType]=None, dt: float=1.0) -> DynType:
         """
         Update the system to the next time step, optionally with a new target value
-        # Fixme: There is a HUGE potential for speed gains if we don't create many temporary ndarray
+
+        Real valued systems are integrated in-place without temporary arrays, and 0-d float64
+        ones with plain Python floats, both with the same results as the generic path
 
         Args:
             target: Next target value to reach, None for previous
@@ -218,6 +249,12 @@ class DynamicNumber(NumberDunder, Number):
 
         # Todo: instant mode
 
+        if isinstance(self.value, np.ndarray):
+            if (self.value.ndim == 0) and (self.value.dtype == np.float64):
+                return self._next_scalar(dt)
+            if (self.value.dtype.kind == "f"):
+                return self._next_inplace(dt)
+
         # Optimization: Do not compute if within precision to target
         if (np.abs(self.target - self.value).max() < self.precision):
             if (self.integrate):
@@ -227,19 +264,7 @@ class DynamicNumber(NumberDunder, Number):
         # "Estimate velocity"
         velocity = (self.target - self.previous)/dt
         self.previous = self.target
-
-        # "Clamp k2 to stable values without jitter"
-        if (self.radians*dt < self.zeta):
-            k1 = self.k1
-            k2 = max(k1*dt, self.k2, 0.5*(k1+dt)*dt)
-
-        # "Use pole matching when the system is very fast"
-        else:
-            t1 = math.exp(-1 * self.zeta * self.radians * dt)
-            a1 = 2 * t1 * (math.cos if self.zeta <= 1 else math.cosh)(self.damping*dt)
-            t2 = 1/(1 + t1*t1 - a1) * dt
-            k1 = t2 * (1 - t1*t1)
-            k2 = t2 * dt
+        k1, k2 = self.coefficients(dt)
 
         # Integrate values
         self.value       += (self.derivative * dt)
@@ -249,6 +274,123 @@ class DynamicNumber(NumberDunder, Number):
             self.integral += (self.value * dt)
         return self.value
 
+    def _next_scalar(self, dt: float) -> DynType:
+        value, target = float(self.value), float(self.target)
+
+        if (abs(target - value) < self.precision):
+            if (self.integrate):
+                self.integral += (value * dt)
+            return self.value
+
+        velocity = (target - float(self.previous))/dt
+        self.previous = self.target
+        k1, k2 = self.coefficients(dt)
+
+        derivative = float(self.derivative)
+        value += (derivative * dt)
+        acceleration = (target + self.k3*velocity - value - k1*derivative)/k2
+        self.value[...] = value
+        self.acceleration = np.array(acceleration)
+        self.derivative += (acceleration * dt)
+        if (self.integrate):
+            self.integral += (value * dt)
+        return self.value
+
+    def advance(self, dt: float, target: Optional[DynType]=None) -> DynType:
+        """
+        Jump the system exactly over a long time interval with a held target, in O(1)
+
+        With a constant target x, the continuous system y + k1*y' + k2*y'' = x is linear on the
+        error state s = (y - x, y'), whose exact solution after t seconds is s(t) = exp(A*t)*s(0)
+        with A = [[0, 1], [-1/k2, -k1/k2]], computed in closed form for the 2x2 matrix
+
+        Note: The response term (k3) only kicks on target changes, a new one isn't modeled
+
+        Args:
+            dt:     Time interval to jump over, in seconds
+            target: New target value held during the interval, None for the current one
+
+        Returns:
+            The system's self.value
+        """
+        if (target is not None):
+            self.target = self._ensure_numpy(target)
+
+            if (self.target.shape != self.value.shape):
+                self.set(target)
+
+        if (not dt):
+            return self.value
+
+        # Eigenvalues of A are half ± mu, exp(A*t) = c*I + s*(A - half*I)
+        k1, k2 = self.k1, self.k2
+        half = -k1/(2*k2)
+        mu   = cmath.sqrt(half*half - 1/k2)
+        if abs(mu*dt) < 1:
+            c = cmath.exp(half*dt) * cmath.cosh(mu*dt)
+            s = cmath.exp(half*dt) * (cmath.sinh(mu*dt)/mu if mu else dt)
+        else:
+            # Avoid cosh overflows on overdamped systems
+            plus, minus = cmath.exp((half + mu)*dt), cmath.exp((half - mu)*dt)
+            c, s = (plus + minus)/2, (plus - minus)/(2*mu)
+        c, s = (c.real, s.real)
+        e00, e01 = (c - s*half), s
+        e10, e11 = (-s/k2), (c - s*k1/k2 - s*half)
+
+        error, derivative = (self.value - self.target), self.derivative
+
+        # Integral of exp(A*t) over the interval is inv(A)*(exp(A*t) - I)
+        if (self.integrate):
+            f00 = -k1*(e00 - 1) - k2*e10
+            f01 = -k1*e01 - k2*(e11 - 1)
+            self.integral = self.integral + (self.target*dt + f00*error + f01*derivative)
+
+        self.value        = self.target + (e00*error + e01*derivative)
+        self.derivative   = (e10*error + e11*derivative)
+        self.acceleration = (self.target - self.value - k1*self.derivative)/k2
+        self.previous     = deepcopy(self.target)
+        return self.value
+
+    _work: np.ndarray = None
+    _velocity: np.ndarray = None
+
+    def _next_inplace(self, dt: float) -> DynType:
+        value = self.value
+
+        # (Re)allocate work arrays, own the state the generic path might alias or replace
+        if (self._work is None) or (self._work.shape != value.shape) or (self._work.dtype != value.dtype):
+            self._work, self._velocity = np.zeros_like(value), np.zeros_like(value)
+            for name in ("previous", "acceleration", "derivative", "integral"):
+                state = getattr(self, name)
+                if (not isinstance(state, np.ndarray)) or (state.shape != value.shape) or (state is self.target):
+                    setattr(self, name, np.array(np.broadcast_to(state, value.shape), dtype=value.dtype))
+        work, velocity = self._work, self._velocity
+
+        # Optimization: Do not compute if within precision to target
+        np.subtract(self.target, value, out=work)
+        if (np.abs(work, out=work).max() < self.precision):
+            if (self.integrate):
+                np.add(self.integral, np.multiply(value, dt, out=work), out=self.integral)
+            return value
+
+        # "Estimate velocity"
+        np.subtract(self.target, self.previous, out=velocity)
+        np.divide(velocity, dt, out=velocity)
+        np.copyto(self.previous, self.target)
+        k1, k2 = self.coefficients(dt)
+
+        # Integrate values
+        np.add(value, np.multiply(self.derivative, dt, out=work), out=value)
+        acceleration = np.multiply(velocity, self.k3, out=self.acceleration)
+        np.add(self.target, acceleration, out=acceleration)
+        np.subtract(acceleration, value, out=acceleration)
+        np.subtract(acceleration, np.multiply(self.derivative, k1, out=work), out=acceleration)
+        np.divide(acceleration, k2, out=acceleration)
+        np.add(self.derivative, np.multiply(acceleration, dt, out=work), out=self.derivative)
+        if (self.integrate):
+            np.add(self.integral, np.multiply(value, dt, out=work), out=self.integral)
+        return value
+
     @staticmethod
     def extract(*objects: Union[Number, Self]) -> tuple[Number]:
         """Extract the values from DynamicNumbers objects or return the same object"""
@@ -267,6 +409,15 @@ class ShaderDynamics(ShaderModule, DynamicNumber):
     differentiate: bool = False
     """Where to output the derivative of the system as a uniform"""
 
+    batched: bool = True
+    """Allow the scene's solver to step this system packed with others, when real valued and N-d"""
+
+    _packed: bool = False
+    """Whether the scene's solver is stepping this system, its state are views of a pack"""
+
+    _reassigns: bool = False
+    """Whether the target was seen replaced while packed, keeps it on the per-module path"""
+
     def build(self) -> None:
         DynamicNumber.__attrs_post_init__(self)
 
@@ -274,6 +425,9 @@ class ShaderDynamics(ShaderModule, DynamicNumber):
         self.reset(instant=self.scene.freewheel)
 
     def update(self) -> None:
+        if self._packed:
+            return None
+
         # Note: abs(dt) the system is unstable backwards in time (duh)
         self.next(dt=abs(self.scene.rdt if self.real else self.scene.dt))
 
@@ -303,3 +457,210 @@ class ShaderDynamics(ShaderModule, DynamicNumber):
 
         if (self.differentiate):
             yield Uniform(self.type, f"{self.name}Derivative", self.derivative)
+
+# ---------------------------------------------------------------------------- #
+
+@define(eq=False)
+class DynamicsPack:
+    """Contiguous state of many real valued systems of the same dtype, stepped at once"""
+
+    members: list[ShaderDynamics]
+    real: bool
+    dtype: np.dtype
+
+    states: dict[str, np.ndarray] = Factory(dict)
+    """Packed arrays of each state, all systems flattened one after another"""
+
+    views: list[dict[str, np.ndarray]] = Factory(list)
+    """Each member's views into the packed states"""
+
+    starts: np.ndarray = None
+    sizes:  np.ndarray = None
+
+    _parameters: dict[str, np.ndarray] = Factory(dict)
+    """Per system parameters and coefficients, rebuilt when any change or on new time steps"""
+
+    _revision: tuple[int, float] = None
+    """The (parameters revision, time step) the cached arrays are valid for"""
+
+    STATES = ("value", "target", "previous", "derivative", "acceleration", "integral")
+
+    def __attrs_post_init__(self):
+        self.sizes  = np.array([member.value.size for member in self.members])
+        self.starts = np.concatenate(([0], np.cumsum(self.sizes)[:-1]))
+        for name in (*self.STATES, "velocity"):
+            self.states[name] = np.zeros(self.sizes.sum(), dtype=self.dtype)
+        for index, member in enumerate(self.members):
+            self.views.append(dict())
+            self.adopt(index)
+            member._packed = True
+
+    def adopt(self, index: int) -> None:
+        """Copy a member's state into the pack, and point it to views of it"""
+        member = self.members[index]
+        start, size = (self.starts[index], self.sizes[index])
+        for name in self.STATES:
+            view = self.states[name][start:start+size].reshape(member.value.shape)
+            np.copyto(view, np.broadcast_to(getattr(member, name), view.shape))
+            self.views[index][name] = view
+            setattr(member, name, view)
+
+    def compatible(self) -> bool:
+        """Re-adopt members whose whole state were replaced (set, reset), False if any changed
+        shape, dtype or time step source, or had only its target replaced (evicted for good)"""
+        for index, member in enumerate(self.members):
+            views = self.views[index]
+            if (member.real != self.real):
+                return False
+            if all(getattr(member, name) is view for name, view in views.items()):
+                continue
+
+            # Note: Re-adopting a target replaced every frame costs more than stepping it alone
+            if all(getattr(member, name) is views[name] for name in self.STATES if name != "target"):
+                member._reassigns = True
+                return False
+
+            value = member.value
+            if (not DynamicsSolver.packable(member)) or (value.shape != views["value"].shape) \
+                or (value.dtype != self.dtype):
+                return False
+            self.adopt(index)
+        return True
+
+    def step(self, dt: float) -> None:
+        if (not dt):
+            return None
+
+        state = self.states
+        value, target, previous = (state["value"], state["target"], state["previous"])
+        derivative, acceleration = (state["derivative"], state["acceleration"])
+        velocity = state["velocity"]
+        parameters = self.parameters(dt)
+        k1, k2, k3 = (parameters["k1"], parameters["k2"], parameters["k3"])
+
+        # Systems within precision of their target don't move
+        active = (np.maximum.reduceat(np.abs(target - value), self.starts) >= parameters["precision"])
+        where  = np.repeat(active, self.sizes)
+
+        # "Estimate velocity"
+        np.subtract(target, previous, out=velocity)
+        np.divide(velocity, dt, out=velocity)
+        np.copyto(previous, target, where=where)
+
+        # Integrate values
+        np.add(value, derivative*dt, out=value, where=where)
+        np.copyto(acceleration, (target + k3*velocity - value - k1*derivative)/k2, where=where, casting="same_kind")
+        np.add(derivative, acceleration*dt, out=derivative, where=where)
+        if (integrate := parameters["integrate"]).any():
+            np.add(state["integral"], value*dt, out=state["integral"], where=integrate)
+
+    def parameters(self, dt: float) -> dict[str, np.ndarray]:
+        """Per system parameters and (k1, k2, k3) coefficients repeated per element, cached"""
+        if (self._revision == (DynamicNumber.revision, dt)):
+            return self._parameters
+
+        frequency = np.array([member.frequency for member in self.members], dtype=np.float64)
+        zeta      = np.array([member.zeta      for member in self.members], dtype=np.float64)
+        response  = np.array([member.response  for member in self.members], dtype=np.float64)
+        precision = np.array([member.precision for member in self.members], dtype=np.float64)
+        integrate = np.array([member.integrate for member in self.members], dtype=bool)
+
+        with np.errstate(all="ignore"):
+            radians = (tau * frequency)
+
+            # "Clamp k2 to stable values without jitter"
+            slow_k1 = zeta / (pi * frequency)
+            slow_k2 = np.maximum(np.maximum(slow_k1*dt, 1.0/(radians*radians)), 0.5*(slow_k1+dt)*dt)
+
+            # "Use pole matching when the system is very fast"
+            damping = radians * np.sqrt(np.abs(zeta*zeta - 1.0))
+            t1 = np.exp(-1 * zeta * radians * dt)
+            a1 = 2 * t1 * np.where(zeta <= 1, np.cos(damping*dt), np.cosh(damping*dt))
+            t2 = 1/(1 + t1*t1 - a1) * dt
+            fast = (radians*dt >= zeta)
+
+            self._parameters = dict(
+                precision=precision,
+                integrate=np.repeat(integrate, self.sizes),
+                k1=np.repeat(np.where(fast, t2 * (1 - t1*t1), slow_k1), self.sizes),
+                k2=np.repeat(np.where(fast, t2 * dt, slow_k2), self.sizes),
+                k3=np.repeat((response * zeta) / (tau * frequency), self.sizes),
+            )
+
+        self._revision = (DynamicNumber.revision, dt)
+        return self._parameters
+
+
+@define(eq=False)
+class DynamicsSolver:
+    """
+    Steps runs of many real valued ShaderDynamics of a scene in a few vectorized calls instead
+    of one Python and NumPy round per system, with per system parameters. Systems are packed by
+    runs of adjacent dynamics modules (like the ones a module creates), time step source (real
+    or scene) and dtype, each run stepped where its first system would update, so all modules
+    see the same values as unpacked. Their state become views into the packs, are re-adopted
+    when replaced (set, reset), and repacked when the modules, shapes or time sources change
+
+    Packing has a fixed overhead, so only runs of `minimum` or more systems are packed. Scalar
+    systems and the ones whose target is replaced (not written into) stay on their faster
+    per-module paths
+    """
+    scene: ShaderScene
+
+    packs: dict[int, dict[tuple[bool, np.dtype], DynamicsPack]] = Factory(dict)
+    """Packs of each run of systems, by the module index the run starts at"""
+
+    minimum: int = 4
+    """Smallest number of systems in a pack, fewer are about as fast stepped alone"""
+
+    _signature: tuple[int, ...] = None
+    """Identities of the scene modules when packed, any change triggers a repack"""
+
+    @staticmethod
+    def packable(member: ShaderDynamics) -> bool:
+        return member.batched \
+            and (not member._reassigns) \
+            and isinstance(member.value, np.ndarray) \
+            and isinstance(member.target, np.ndarray) \
+            and (member.value.ndim > 0) \
+            and (member.value.dtype.kind == "f") \
+            and (member.target.shape == member.value.shape)
+
+    def repack(self) -> None:
+        for run in self.packs.values():
+            for pack in run.values():
+                for member in pack.members:
+                    member._packed = False
+
+        groups, start = dict(), None
+        for index, module in enumerate(self.scene.modules):
+            if not isinstance(module, ShaderDynamics):
+                start = None
+                continue
+            start = (index if (start is None) else start)
+            if self.packable(module):
+                groups.setdefault(start, dict()).setdefault((module.real, module.value.dtype), []).append(module)
+        self.packs = dict()
+        for start, run in groups.items():
+            for (real, dtype), members in run.items():
+                if (len(members) >= self.minimum):
+                    self.packs.setdefault(start, dict())[(real, dtype)] = \
+                        DynamicsPack(members=members, real=real, dtype=dtype)
+        self._signature = tuple(map(id, self.scene.modules))
+
+    def prepare(self) -> None:
+        """Repack if scene modules were added, removed or replaced, call once per frame"""
+        if (self._signature != tuple(map(id, self.scene.modules))):
+            self.repack()
+
+    def step(self, index: int) -> None:
+        """Step the packed systems whose run starts at a module index, call before its update"""
+        if (packs := self.packs.get(index)) is None:
+            return None
+        if not all(pack.compatible() for pack in packs.values()):
+            self.repack()
+            packs = self.packs.get(index, dict())
+
+        # Note: abs(dt) the system is unstable backwards in time (duh)
+        for (real, _), pack in packs.items():
+            pack.step(dt=abs(self.scene.rdt if real else self.scene.dt))
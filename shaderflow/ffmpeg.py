@@ -1,19 +1,22 @@
 import contextlib
 import functools
-import io
+import json
 import re
 import shutil
 import subprocess
+import tempfile
 from abc import ABC, abstractmethod
 from collections import deque
 from collections.abc import Iterable
 from enum import Enum
+from fractions import Fraction
 from pathlib import Path
 from subprocess import PIPE, Popen
 from typing import (
     Annotated,
     Any,
     Generator,
+    Iterator,
     Optional,
     Self,
     TypeAlias,
@@ -21,9 +24,11 @@ from typing import (
 )
 
 import numpy as np
-from attrs import Factory, define
+import xxhash
+from attrs import Factory, define, field
 from cyclopts import App, Parameter
 
+import shaderflow
 from shaderflow import logger
 
 
@@ -53,7 +58,11 @@ class FFmpegModuleBase(ABC):
 class FFmpegInputPath(FFmpegModuleBase):
     path: Path
 
+    seek: Optional[float] = None
+    """Start reading at this time in seconds, a fast keyframe seek followed by an exact decode"""
+
     def command(self, ffmpeg: 'FFmpeg') -> Iterable[str]:
+        yield from every("-ss", self.seek)
         yield from ("-i", self.path)
 
 
@@ -86,9 +95,28 @@ class FFmpegInputPipe(FFmpegModuleBase):
         yield from ("-i", "-")
 
 
+@define(kw_only=True)
+class FFmpegInputPCM(FFmpegModuleBase):
+    """Headerless interleaved audio samples, from a file or a named pipe being written to"""
+    path: Path
+
+    format: str = "s16le"
+    """Raw format of the samples, `ffmpeg -formats | grep PCM`"""
+
+    samplerate: int = 44100
+    channels: int = 2
+
+    def command(self, ffmpeg: "FFmpeg") -> Iterable[str]:
+        yield from ("-f", self.format)
+        yield from ("-ar", self.samplerate)
+        yield from ("-ac", self.channels)
+        yield from ("-i", self.path)
+
+
 FFmpegInputType: TypeAlias = Union[
     FFmpegInputPath,
     FFmpegInputPipe,
+    FFmpegInputPCM,
 ]
 
 # ---------------------------------------------------------------------------- #
@@ -125,8 +153,9 @@ class FFmpegOutputPipe(FFmpegModuleBase):
     format: Format = Format.Mpegts
 
     class PixelFormat(str, Enum):
-        RGB24 = "rgb24"
-        RGBA  = "rgba"
+        RGB24   = "rgb24"
+        RGBA    = "rgba"
+        YUV420P = "yuv420p"
 
     pixel_format: Optional[PixelFormat] = None
 
@@ -764,6 +793,9 @@ class FFmpeg:
     shortest: bool = False
     """Ends the video at the shortest input's duration"""
 
+    mix: bool = False
+    """Mix all audio inputs (files and PCM) into one stream, else FFmpeg picks only one of them"""
+
     stream_loop: int = 0
     """Loops the input stream N times to the right"""
 
@@ -886,10 +918,15 @@ class FFmpeg:
     def pipe_input(self, **options) -> Self:
         return self.smartset(FFmpegInputPipe(**options))
 
+    @functools.wraps(FFmpegInputPCM)
+    def pcm_input(self, path: Path, **options) -> Self:
+        return self.smartset(FFmpegInputPCM(path=path, **options))
+
     def cli_inputs(self, app: App) -> None:
         with contextlib.nullcontext("📦 (FFmpeg) Input") as group:
             app.command(FFmpegInputPath, name="ipath", group=group, result_action=self.inputs.append)
             app.command(FFmpegInputPipe, name="ipipe", group=group, result_action=self.inputs.append)
+            app.command(FFmpegInputPCM,  name="ipcm",  group=group, result_action=self.inputs.append)
 
     @functools.wraps(FFmpegOutputPath)
     def output(self, path: Path, **options) -> Self:
@@ -1053,8 +1090,20 @@ class FFmpeg:
         if self.shortest:
             command.append("-shortest")
 
+        # Sum the audio inputs at their original levels, keep the piped videos
+        maps = list()
+        audios = [index for index, item in enumerate(self.inputs) if not isinstance(item, FFmpegInputPipe)]
+        if self.mix and (len(audios) > 1):
+            command.extend(("-filter_complex", "".join(f"[{index}:a]" for index in audios) + \
+                f"amix=inputs={len(audios)}:duration=longest:normalize=0[mix]"))
+            for index, item in enumerate(self.inputs):
+                if isinstance(item, FFmpegInputPipe):
+                    maps.extend(("-map", f"{index}:v"))
+            maps.extend(("-map", "[mix]"))
+
         # Note: https://trac.ffmpeg.org/wiki/Creating%20multiple%20outputs
         for output in self.outputs:
+            command.extend(maps)
             if self.acodec is not None:
                 command.extend(self.acodec.command(self))
             if self.vcodec is not None:
@@ -1101,16 +1150,51 @@ class FFmpeg:
 
     @staticmethod
     @functools.lru_cache
-    def get_video_resolution(path: Path, *, echo: bool=True) -> Optional[tuple[int, int]]:
-        """Get the resolution of a video in a smart way"""
+    def probe(path: Path, *, echo: bool=True) -> Optional[dict]:
+        """Streams and format metadata of a file from a single ffprobe, cached on disk by stat"""
         if (path is None) or not (path := Path(path)).exists():
             return None
-        logger.info(f"Getting Video Resolution of ({path})")
-        import PIL
-        return PIL.Image.open(io.BytesIO(subprocess.run((
-            "ffmpeg", "-hide_banner", "-loglevel", "error",
-            "-i", path, "-vframes", "1", "-f", "image2pipe", "-",
-        ), stdout=PIPE).stdout), formats=["jpeg"]).size
+
+        # Note: Hashing the contents could take longer than probing large videos
+        stat  = path.stat()
+        key   = xxhash.xxh3_128_hexdigest(f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        cache = (shaderflow.directories.user_cache_path/"probe"/f"{key}.json")
+
+        if cache.exists():
+            return json.loads(cache.read_text())
+
+        logger.info(f"Probing file ({path})")
+        probe = json.loads(subprocess.check_output((
+            "ffprobe", "-hide_banner", "-loglevel", "error",
+            "-show_streams", "-show_format",
+            "-of", "json", "-i", str(path),
+        )))
+        with partial_file(cache) as partial:
+            partial.write_text(json.dumps(probe))
+        return probe
+
+    @staticmethod
+    def probe_stream(path: Path, type: str, index: int=0) -> Optional[dict]:
+        """Metadata of the index-th stream of a type (video, audio, subtitle) of a file"""
+        if (probe := FFmpeg.probe(path)) is None:
+            return None
+        streams = [stream for stream in probe.get("streams", []) if (stream.get("codec_type") == type)]
+        return streams[index] if (index < len(streams)) else None
+
+    @staticmethod
+    @functools.lru_cache
+    def get_video_resolution(path: Path, *, echo: bool=True) -> Optional[tuple[int, int]]:
+        if (stream := FFmpeg.probe_stream(path, "video")) is None:
+            return None
+        width, height = (int(stream["width"]), int(stream["height"]))
+
+        # Decoders autorotate, swap the coded size of portrait phone videos
+        rotation = stream.get("tags", {}).get("rotate", 0)
+        for data in stream.get("side_data_list", []):
+            rotation = data.get("rotation", rotation)
+        if (round(float(rotation)) % 180 == 90):
+            return (height, width)
+        return (width, height)
 
     @staticmethod
     def iter_video_frames(path: Path, *, skip: int=0, echo: bool=True) -> Optional[Iterable[np.ndarray]]:
@@ -1148,8 +1232,10 @@ class FFmpeg:
     @functools.lru_cache
     def get_video_total_frames(path: Path, *, echo: bool=True) -> Optional[int]:
         """Count the total frames of a video by decode voiding and parsing stats output"""
-        if (path is None) or not (path := Path(path)).exists():
+        if (stream := FFmpeg.probe_stream(path, "video")) is None:
             return None
+        if (frames := stream.get("nb_frames")):
+            return int(frames)
         logger.info(f"Getting total frames ({path}), might take a while..")
         return int(re.compile(r"frame=\s*(\d+)").findall((
             FFmpeg(vsync="cfr")
@@ -1160,72 +1246,56 @@ class FFmpeg:
     @staticmethod
     @functools.lru_cache
     def get_video_duration(path: Path, *, echo: bool=True) -> Optional[float]:
-        if (path is None) or not (path := Path(path)).exists():
+        if (probe := FFmpeg.probe(path)) is None:
+            return None
+        if (duration := probe.get("format", {}).get("duration")) is not None:
+            return float(duration)
+        if (stream := FFmpeg.probe_stream(path, "video")) is None:
             return None
-        logger.info(f"Getting Video Duration of file ({path})")
-        return eval(subprocess.check_output((
-            "ffprobe",
-            "-i", path,
-            "-show_entries", "format=duration",
-            "-v", "quiet", "-of", "csv=p=0",
-        )).decode().strip())
+        if (duration := stream.get("duration")) is not None:
+            return float(duration)
+        if (frames := stream.get("nb_frames")) and (rate := stream.get("r_frame_rate")):
+            return int(frames) / float(Fraction(rate))
+        return None
 
     @staticmethod
     @functools.lru_cache
     def get_video_framerate(path: Path, *, precise: bool=False, echo: bool=True) -> Optional[float]:
-        if (path is None) or not (path := Path(path)).exists():
+        if (stream := FFmpeg.probe_stream(path, "video")) is None:
             return None
-        logger.info(f"Getting Video Framerate of file ({path})")
         if precise:
             A = FFmpeg.get_video_total_frames(path)
             B = FFmpeg.get_video_duration(path)
             return (A/B)
         else:
-            return eval(subprocess.check_output((
-                "ffprobe", "-hide_banner", "-loglevel", "error",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                "-show_entries", "stream=r_frame_rate",
-                "-select_streams", "v:0",
-                "-i", path,
-            )).decode().strip())
+            return float(Fraction(stream["r_frame_rate"]))
 
     # # Audio
 
     @staticmethod
     @functools.lru_cache
     def get_audio_samplerate(path: Path, *, stream: int=0, echo: bool=True) -> Optional[int]:
-        if (path is None) or not (path := Path(path)).exists():
+        if (info := FFmpeg.probe_stream(path, "audio", stream)) is None:
             return None
-        logger.info(f"Getting Audio Samplerate of file ({path})")
-        return eval(subprocess.check_output((
-            "ffprobe",
-            "-show_entries", "stream=sample_rate",
-            "-v", "quiet", "-of", "csv=p=0",
-            "-i", str(path),
-        )).decode().strip().splitlines()[stream])
+        return int(info["sample_rate"])
 
     @staticmethod
     @functools.lru_cache
     def get_audio_channels(path: Path, *, stream: int=0, echo: bool=True) -> Optional[int]:
-        if (path is None) or not (path := Path(path)).exists():
+        if (info := FFmpeg.probe_stream(path, "audio", stream)) is None:
             return None
-        logger.info(f"Getting Audio Channels of file ({path})")
-        return eval(subprocess.check_output((
-            "ffprobe",
-            "-i", str(path),
-            "-show_entries", "stream=channels",
-            "-v", "quiet", "-of", "csv=p=0",
-        )).decode().strip().splitlines()[stream])
+        return int(info["channels"])
 
     @staticmethod
+    @functools.lru_cache
     def get_audio_duration(path: Path, *, echo: bool=True) -> Optional[float]:
-        if (path is None) or not (path := Path(path)).exists():
+        if (probe := FFmpeg.probe(path)) is None:
             return None
-        try:
-            generator = BrokenAudioReader(path=path, chunk=10).stream
-            while next(generator) is not None: ...
-        except StopIteration as result:
-            return result.value
+        if (duration := probe["format"].get("duration")) is not None:
+            return float(duration)
+        if (stream := FFmpeg.probe_stream(path, "audio")) is not None:
+            return float(stream.get("duration", 0))
+        return None
 
     @staticmethod
     def get_audio_numpy(path: Path, *, echo: bool=True) -> Optional[np.ndarray]:
@@ -1295,7 +1365,7 @@ class BrokenAudioReader:
             FFmpeg()
             .quiet()
             .input(path=self.path)
-            .pcm(self.format.value)
+            .pcm(self.format)
             .no_video()
             .output("-")
         ).popen(stdout=PIPE, stderr=PIPE)
@@ -1331,3 +1401,134 @@ class BrokenAudioReader:
 
         # Allow to catch total duration on GeneratorExit
         return self.time
+
+
+@contextlib.contextmanager
+def partial_file(path: Path) -> Iterator[Path]:
+    """
+    An unique temporary path next to `path` to write into, replacing it only once the block
+    succeeds, so neither interrupted nor concurrent writers leave readers a partial file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix=".partial", delete=False) as file:
+        partial = Path(file.name)
+    try:
+        yield partial
+        partial.replace(path)
+    finally:
+        partial.unlink(missing_ok=True)
+
+
+@define
+class BrokenAudioFile:
+    """
+    Random access to a whole audio file, decoded once with FFmpeg into a memory mapped float32
+    raw file, serving exact sample windows at any time for seeking and deterministic exports
+
+    Decoded files and their metadata are kept in the user cache directory keyed by the hash of
+    the file's contents, so repeated runs of the same track start instantly
+    """
+    path: Path
+
+    channels: int = None
+    """The number of audio channels in the file"""
+
+    samplerate: int = None
+    """The sample rate of the audio file"""
+
+    data: np.ndarray = field(default=None, repr=False)
+    """Memory mapped decoded samples, shape: (samples, channels)"""
+
+    cache: Path = None
+    """Decoded raw pcm_f32le file backing the data, with a sibling .json metadata"""
+
+    def __attrs_post_init__(self):
+        self.path = Path(self.path)
+        self.decode()
+
+    @staticmethod
+    def directory() -> Path:
+        return (shaderflow.directories.user_cache_path/"audio")
+
+    @staticmethod
+    @functools.lru_cache
+    def digest(path: Path, size: int, mtime: int) -> str:
+        """Hash of a file's contents, reused while its size and modification time are the same"""
+        digest = xxhash.xxh3_128()
+        with open(path, "rb") as file:
+            while (chunk := file.read(2**20)):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @property
+    def key(self) -> str:
+        stat = self.path.stat()
+        return BrokenAudioFile.digest(self.path.resolve(), stat.st_size, stat.st_mtime_ns)
+
+    def decode(self) -> None:
+        self.cache = (self.directory()/f"{self.key}.f32le")
+        metadata = self.cache.with_suffix(".json")
+
+        # Note: Metadata is written last, but the decoded file might have been deleted
+        if metadata.exists() and self.cache.exists():
+            logger.info(f"Using cached decoded audio of ({self.path})")
+            metadata = json.loads(metadata.read_text())
+            self.channels   = metadata["channels"]
+            self.samplerate = metadata["samplerate"]
+        else:
+            self.channels   = FFmpeg.get_audio_channels(self.path)
+            self.samplerate = FFmpeg.get_audio_samplerate(self.path)
+
+            logger.info(f"Decoding audio file ({self.path}) to cache ({self.cache})")
+            with partial_file(self.cache) as partial:
+                (FFmpeg()
+                    .quiet()
+                    .input(path=self.path)
+                    .pcm(FFmpegPCM.PCM_FLOAT_32_BITS_LITTLE_ENDIAN)
+                    .no_video()
+                    .output(path=partial, pixel_format=None)
+                ).run(check=True)
+
+            samples = self.cache.stat().st_size // (4*self.channels)
+            with partial_file(metadata) as partial:
+                partial.write_text(json.dumps(dict(
+                    path=str(self.path),
+                    channels=self.channels,
+                    samplerate=self.samplerate,
+                    samples=samples,
+                    duration=(samples/self.samplerate),
+                )))
+
+        # Note: Can't memory map empty files
+        if (self.cache.stat().st_size == 0):
+            self.data = np.zeros((0, self.channels), dtype=np.float32)
+        else:
+            self.data = np.memmap(self.cache, dtype=np.float32, mode="r").reshape(-1, self.channels)
+
+    @property
+    def samples(self) -> int:
+        return len(self.data)
+
+    @property
+    def duration(self) -> float:
+        return (self.samples / self.samplerate)
+
+    def window(self, start: int, end: int) -> np.ndarray:
+        """
+        Exact samples between [start, end), zero padded outside the file's bounds
+
+        Returns:
+            A view when fully within the file, or a padded copy, shape: (channels, end - start)
+        """
+        start, end = int(start), int(end)
+        if (0 <= start) and (end <= self.samples):
+            return self.data[start:end].T
+        window = np.zeros((self.channels, max(0, end - start)), dtype=np.float32)
+        lower, upper = max(start, 0), min(end, self.samples)
+        if (lower < upper):
+            window[:, lower-start:upper-start] = self.data[lower:upper].T
+        return window
+
+    def seconds(self, start: float, end: float) -> np.ndarray:
+        return self.window(round(start*self.samplerate), round(end*self.samplerate))
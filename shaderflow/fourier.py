@@ -0,0 +1,122 @@
+import functools
+import os
+import time
+from enum import Enum
+from typing import ClassVar, Optional
+
+import numpy as np
+from attrs import Factory, define, field
+
+from shaderflow import logger
+
+NUMPY2: bool = (np.lib.NumpyVersion(np.__version__) >= "2.0.0")
+"""Whether numpy's FFTs accept an `out=` array, added in 2.0"""
+
+
+class FourierBackend(str, Enum):
+    """Library computing the real FFTs of audio modules"""
+    Auto   = "auto"
+    Numpy  = "numpy"
+    Scipy  = "scipy"
+    PyFFTW = "pyfftw"
+
+    @property
+    def available(self) -> bool:
+        try:
+            if (self is FourierBackend.Scipy):
+                import scipy.fft
+            elif (self is FourierBackend.PyFFTW):
+                import pyfftw
+        except ImportError:
+            return False
+        return True
+
+
+@define
+class BrokenFourier:
+    """
+    Real FFTs by a pluggable backend, either a fixed one or the fastest available for each
+    (shape, dtype) found by a quick benchmark on first use. Unlike NumPy's, both SciPy and
+    pyFFTW backends split multi-channel or batched transforms across threads
+    """
+
+    backend: FourierBackend = field(default=FourierBackend.Auto, converter=FourierBackend)
+    """The backend to use, Auto to benchmark or use the global `preferred` one"""
+
+    workers: int = field(factory=lambda: os.cpu_count() or 1)
+    """Number of threads for backends supporting it"""
+
+    preferred: ClassVar[Optional[FourierBackend]] = None
+    """Global override of Auto backends, for example from the command line"""
+
+    _fastest: ClassVar[dict[tuple, FourierBackend]] = dict()
+    """Benchmark results of the Auto backend, shared by all instances"""
+
+    _plans: dict[tuple, object] = Factory(dict)
+    """Cached pyFFTW plans (builders) by shape and dtype"""
+
+    @staticmethod
+    @functools.cache
+    def installed(backend: FourierBackend) -> FourierBackend:
+        """The backend itself if available, else NumPy's, warning only once"""
+        if (not backend.available):
+            logger.warn(f"FFT backend {backend.value} isn't installed, falling back to numpy")
+            return FourierBackend.Numpy
+        return backend
+
+    def resolve(self, shape: tuple[int, ...], dtype: np.dtype) -> FourierBackend:
+        if (self.backend is not FourierBackend.Auto):
+            return BrokenFourier.installed(self.backend)
+        if (BrokenFourier.preferred not in (None, FourierBackend.Auto)):
+            return BrokenFourier.installed(BrokenFourier.preferred)
+        if (key := (tuple(shape), np.dtype(dtype))) not in BrokenFourier._fastest:
+            BrokenFourier._fastest[key] = self.benchmark(*key)
+        return BrokenFourier._fastest[key]
+
+    def benchmark(self, shape: tuple[int, ...], dtype: np.dtype, *, repeat: int=20) -> FourierBackend:
+        """Find the fastest available backend for transforms of a shape and dtype"""
+        data = np.random.default_rng(0).standard_normal(shape).astype(dtype)
+        timings = dict()
+
+        for backend in FourierBackend:
+            if (backend is FourierBackend.Auto) or (not backend.available):
+                continue
+            self._rfft(backend, data)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                self._rfft(backend, data)
+            timings[backend] = (time.perf_counter() - start)
+
+        fastest = min(timings, key=timings.get)
+        logger.info(f"Using {fastest.value} for FFTs of shape {shape} ({np.dtype(dtype)})")
+        return fastest
+
+    def _rfft(self, backend: FourierBackend, data: np.ndarray, out: np.ndarray=None) -> np.ndarray:
+        if (backend is FourierBackend.Scipy):
+            import scipy.fft
+            result = scipy.fft.rfft(data, workers=self.workers)
+
+        elif (backend is FourierBackend.PyFFTW):
+            if (plan := self._plans.get(key := (data.shape, data.dtype))) is None:
+                import pyfftw
+                plan = self._plans[key] = pyfftw.builders.rfft(
+                    pyfftw.empty_aligned(data.shape, dtype=data.dtype),
+                    threads=self.workers, planner_effort="FFTW_MEASURE",
+                )
+            result = plan(data)
+
+        elif (NUMPY2):
+            return np.fft.rfft(data, out=out)
+
+        # Note: numpy < 2.0 has no `out=`, and always computes in double precision
+        else:
+            result = np.fft.rfft(data)
+
+        if (out is None):
+            return result.copy() if (backend is FourierBackend.PyFFTW) else result
+        np.copyto(out, result)
+        return out
+
+    def rfft(self, data: np.ndarray, *, out: np.ndarray=None) -> np.ndarray:
+        """Real FFT of the last axis, optionally written into `out`"""
+        return self._rfft(self.resolve(data.shape, data.dtype), data, out=out)
@@ -1,3 +1,4 @@
+import tracemalloc
 from collections import deque
 
 import numpy as np
@@ -12,6 +13,14 @@ class ShaderFrametimer(ShaderModule):
     frametimes: deque[float] = Factory(deque)
     history: float = 2
 
+    allocations: deque[int] = Factory(deque)
+    """Peak bytes allocated on top of the previous frame's, while tracing"""
+
+    trace: bool = False
+    """Trace Python and NumPy memory allocations per frame, has a noticeable overhead"""
+
+    _traced: int = 0
+
     @property
     def length(self) -> int:
         return max(int(self.history * self.scene.fps), 10)
@@ -24,6 +33,27 @@ class ShaderFrametimer(ShaderModule):
         self.frametimes.append(self.scene.rdt)
         while len(self.frametimes) > self.length:
             self.frametimes.popleft()
+        self.trace_memory()
+
+    def trace_memory(self) -> None:
+        if (not self.trace):
+            if tracemalloc.is_tracing() and self._traced:
+                self.allocations.clear()
+                self._traced = 0
+                tracemalloc.stop()
+            return None
+
+        if (not tracemalloc.is_tracing()):
+            tracemalloc.start()
+
+        # Temporaries are freed by the end of the frame, the peak catches them
+        current, peak = tracemalloc.get_traced_memory()
+        if self._traced:
+            self.allocations.append(max(0, peak - self._traced))
+        while len(self.allocations) > self.length:
+            self.allocations.popleft()
+        tracemalloc.reset_peak()
+        self._traced = max(1, current)
 
     def percent(self, percent: float=1) -> np.ndarray:
         cut = int(len(self.frametimes) * (percent/100))
@@ -78,3 +108,17 @@ class ShaderFrametimer(ShaderModule):
 
         if (state := imgui.input_float("History (Seconds)", self.history, 0.5, 0.5, "%.2f"))[0]:
             self.history = max(0, state[1])
+
+        if (state := imgui.checkbox("Trace allocations", self.trace))[0]:
+            self.trace = state[1]
+
+        if self.trace and self.allocations:
+            imgui.plot_lines(
+                (
+                    f"Average {np.mean(self.allocations)/1024:9.1f} KiB/frame\n"
+                    f"Maximum {max(self.allocations)/1024:9.1f} KiB/frame\n"
+                ),
+                np.array(self.allocations, dtype=np.float32),
+                scale_min = 0,
+                graph_size = (0, 70)
+            )
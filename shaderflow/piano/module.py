@@ -1,20 +1,26 @@
+import contextlib
 import itertools
+import os
 import shutil
 import struct
 import sys
+import tempfile
 from collections import deque
 from collections.abc import Iterable
 from pathlib import Path
-from typing import Any, Optional
+from threading import Event, Thread
+from typing import Any, BinaryIO, Optional
 from unittest.mock import patch
 
 import numpy as np
 from attrs import Factory, define
 
+import shaderflow
 from shaderflow import logger
 from shaderflow.dynamics import DynamicNumber
+from shaderflow.ffmpeg import BrokenAudioFile, FFmpeg, partial_file
 from shaderflow.module import ShaderModule
-from shaderflow.piano.notes import PianoNote
+from shaderflow.piano.notes import PianoNote, PianoNotes
 from shaderflow.texture import ShaderTexture
 from shaderflow.variable import ShaderVariable, Uniform
 
@@ -77,8 +83,8 @@ class ShaderPiano(ShaderModule):
         frequency=0.05, zeta=1/(2**0.5), response=0,
     ))
 
-    tree: dict[int, dict[int, deque[PianoNote]]] = Factory(dict)
-    """Internal data structure for storing the notes"""
+    store: PianoNotes = Factory(PianoNotes)
+    """Columnar storage of all notes, indexed by time"""
 
     @property
     def lookup_time(self) -> float:
@@ -92,6 +98,8 @@ class ShaderPiano(ShaderModule):
         self.channel_texture = ShaderTexture(scene=self.scene, name=f"{self.name}Chan").from_numpy(self._empty_keys())
         self.roll_texture    = ShaderTexture(scene=self.scene, name=f"{self.name}Roll").from_numpy(self._empty_roll())
         self.tempo_texture   = ShaderTexture(scene=self.scene, name=f"{self.name}Tempo").from_numpy(np.zeros((100, 1, 2), np.float32))
+        self._roll,     self._roll_next     = (self._empty_roll(), self._empty_roll())
+        self._channels, self._channels_next = (self._empty_keys(), self._empty_keys())
 
     def _empty_keys(self) -> np.ndarray:
         return np.zeros((1, MAX_NOTE), dtype=np.float32)
@@ -101,43 +109,31 @@ class ShaderPiano(ShaderModule):
 
     # # Data structure
 
-    @staticmethod
-    def _ranges(start: float, end: float) -> Iterable[int]:
-        return range(int(start), int(end)+1)
-
     def clear(self):
-        self.tree.clear()
+        self.store.clear()
 
     def add_note(self, note: Optional[PianoNote]) -> None:
         if note is None:
             return
-        for index in self._ranges(note.start, note.end):
-            self.tree.setdefault(note.note, dict()).setdefault(index, deque()).append(note)
+        self.store.add(note)
         self.update_global_ranges(note.note)
 
     @property
     def notes(self) -> Iterable[PianoNote]:
-        for block in self.tree.values():
-            for notes in block.values():
-                yield from notes
+        yield from self.store
 
     @property
     def duration(self) -> float:
-        return max((note.end for note in self.notes), default=0)
+        self.store.commit()
+        return self.store.duration
 
     def __iter__(self) -> Iterable[PianoNote]:
         return self.notes
 
     def notes_between(self, index: int, start: float, end: float) -> Iterable[PianoNote]:
-        exists = set()
-        for other in self._ranges(start, end):
-            for note in self.tree.get(index, dict()).get(other, deque()):
-                if (note.start > end):
-                    continue
-                if (id(note) in exists):
-                    continue
-                exists.add(id(note))
-                yield note
+        for other in self.store.between(start, end):
+            if (self.store.note[other] == index):
+                yield self.store.get(other)
 
     def update_global_ranges(self, note: int) -> None:
         self.global_minimum_note = min(self.global_minimum_note, note)
@@ -145,49 +141,79 @@ class ShaderPiano(ShaderModule):
 
     @property
     def maximum_velocity(self) -> Optional[int]:
-        return max((note.velocity for note in self.notes), default=None)
+        self.store.commit()
+        return self.store.loudest
 
     @property
     def minimum_velocity(self) -> Optional[int]:
-        return min((note.velocity for note in self.notes), default=None)
+        self.store.commit()
+        return self.store.softest
 
     def normalize_velocities(self, minimum: int=100, maximum: int=100) -> None:
         ma, mi = (self.maximum_velocity, self.minimum_velocity)
 
         # Safe against (minimum-maximum=0)
-        def new(velocity: int) -> int:
+        def new(velocity: np.ndarray) -> np.ndarray:
             if (ma != mi):
-                int((velocity - mi)/(ma - mi)*(maximum - minimum) + minimum)
+                return ((velocity - mi)/(ma - mi)*(maximum - minimum) + minimum).astype(int)
             return int((maximum + minimum) / 2)
 
-        for note in self.notes:
-            note.velocity = new(note.velocity)
+        if len(self.store):
+            self.store.velocity[:] = new(self.store.velocity)
+            self.store.measure()
+
+    @staticmethod
+    def parse_midi(path: Path) -> dict[str, np.ndarray]:
+        """Parse a midi file into the note columns of PianoNotes and a (2, N) 'tempo' array"""
+        with patch.dict(sys.modules, pkg_resources=None):
+            import pretty_midi
+
+        midi = pretty_midi.PrettyMIDI(str(path))
+        columns = {name: list() for name in PianoNotes.COLUMNS}
+
+        for channel, instrument in enumerate(midi.instruments):
+            notes = instrument.notes
+            columns["start"].append(np.fromiter((note.start for note in notes), np.float64, len(notes)))
+            columns["end"].append(np.fromiter((note.end for note in notes), np.float64, len(notes)))
+            columns["note"].append(np.fromiter((note.pitch for note in notes), np.int16, len(notes)))
+            columns["velocity"].append(np.fromiter((note.velocity for note in notes), np.int16, len(notes)))
+            columns["channel"].append(np.full(len(notes), channel, np.int16))
+
+        return dict(
+            **{name: np.concatenate(arrays or [np.empty(0)]) for name, arrays in columns.items()},
+            tempo=np.array(midi.get_tempo_changes(), dtype=np.float64),
+        )
 
     def load_midi(self, path: Path):
         if not (path := Path(path)).exists():
             logger.warn(f"Input Midi file not found ({path})")
             return
 
-        with patch.dict(sys.modules, pkg_resources=None):
-            import pretty_midi
+        # Parsed files are cached by their contents, reopening is a single read
+        stat  = path.stat()
+        key   = BrokenAudioFile.digest(path.resolve(), stat.st_size, stat.st_mtime_ns)
+        cache = (shaderflow.directories.user_cache_path/"midi"/f"{key}.npz")
 
-        midi = pretty_midi.PrettyMIDI(str(path))
+        if cache.exists():
+            logger.info(f"Using cached midi notes of ({path})")
+            with np.load(cache) as file:
+                columns = dict(file)
+        else:
+            logger.info(f"Parsing midi file ({path})")
+            columns = self.parse_midi(path)
+            with partial_file(cache) as partial, open(partial, "wb") as file:
+                np.savez(file, **columns)
 
-        for channel, instrument in enumerate(midi.instruments):
-            if instrument.is_drum:
-                pass
-            for note in instrument.notes:
-                self.add_note(PianoNote(
-                    note=note.pitch,
-                    start=note.start,
-                    end=note.end,
-                    channel=channel,
-                    velocity=note.velocity,
-                ))
+        tempos = columns.pop("tempo")
+        self.store.extend(**columns)
+
+        if (self.store.lowest is not None):
+            self.update_global_ranges(self.store.lowest)
+            self.update_global_ranges(self.store.highest)
 
         # Add tempo changes
-        for when, tempo in zip(*midi.get_tempo_changes()):
-            self.tempo.append((when, tempo))
+        for when, tempo in zip(*tempos):
+            self.tempo.append((float(when), float(tempo)))
 
         self.tempo_texture.clear()
 
@@ -196,65 +222,100 @@ class ShaderPiano(ShaderModule):
 
     # # Core Logic
 
-    # A (MAX_MIDI Notes x MAX_CHANNELS Channels) matrix of the end-most note being played
-    _playing_matrix: list[list[Optional[PianoNote]]] = Factory(lambda: [[None]*MAX_CHANNELS for _ in range(MAX_NOTE)])
+    # A (MAX_MIDI Notes x MAX_CHANNELS Channels) matrix of the end-most note being played, NaN if none
+    _playing_matrix: np.ndarray = Factory(lambda: np.full((MAX_NOTE, MAX_CHANNELS), np.nan))
+
+    # Uploaded textures contents, and the next frame's being built, swapped after each upload
+    _roll:          np.ndarray = None
+    _roll_next:     np.ndarray = None
+    _channels:      np.ndarray = None
+    _channels_next: np.ndarray = None
+
+    # Number of leading slots in use of (_roll, _roll_next), the rest are known zeros
+    _roll_depth: list[int] = Factory(lambda: [0, 0])
+
+    def _build_roll(self, upcoming: np.ndarray, time: float) -> np.ndarray:
+        """
+        Scatter the visible notes into the next roll buffer, returns the rows (notes) that
+        differ from the uploaded one. Notes are grouped by pitch with a stable sort, ranked by
+        their position in the group, and clamped to MAX_ROLLING per pitch
+        """
+        store, roll = (self.store, self._roll_next)
+        roll[:, :self._roll_depth[1]] = 0
+
+        # Build a 2D Grid of the piano keys being played, ignoring notes out of the viewport
+        # • Coordinate: (Note, #offset) @ (Start, End, Channel, Velocity)
+        visible = upcoming[store.start[upcoming] < time+self.roll_time]
+        visible = visible[np.argsort(store.note[visible], kind="stable")]
+        note    = store.note[visible]
+        rank    = np.arange(len(visible)) - np.searchsorted(note, note, side="left")
+        keep    = (rank < MAX_ROLLING)
+        visible, note, rank = (visible[keep], note[keep], rank[keep])
+        roll[note, rank, 0] = store.start[visible]
+        roll[note, rank, 1] = store.end[visible]
+        roll[note, rank, 2] = store.channel[visible]
+        roll[note, rank, 3] = store.velocity[visible]
+
+        # Only compare the slots in use by either buffer
+        self._roll_depth[1] = depth = (int(rank.max()) + 1) if len(rank) else 0
+        depth = max(depth, self._roll_depth[0])
+        return np.flatnonzero((roll[:, :depth] != self._roll[:, :depth]).any(axis=(1, 2)))
+
+    @staticmethod
+    def _write_rows(texture: ShaderTexture, data: np.ndarray, rows: np.ndarray) -> None:
+        """Upload only the given rows of a texture's data, merged in contiguous runs"""
+        for run in np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1):
+            if len(run):
+                texture.write(
+                    data=data[run[0]:run[-1]+1],
+                    viewport=(0, int(run[0]), data.shape[1], len(run)),
+                )
 
     def update(self):
+        store = self.store
 
         # Utilities and trackers
         time = (self.scene.time + self.time_offset)
-        upcoming = set()
 
         # # Get and update pressed keys
         self.key_press_dynamics.target.fill(0)
-        roll = self._empty_roll()
 
         # Channel '-1' means the note is not being played !
-        channels = (self._empty_keys() - 1)
-
-        # Optimization: No need to check for the entire range 😉
-        for midi in range(self.global_minimum_note, self.global_maximum_note+1):
-            simultaneous = 0
-
-            for note in self.notes_between(midi, time, time+self.lookup_time):
-                upcoming.add(midi)
-
-                # Ignore notes out of the viewport
-                if (note.start >= time+self.roll_time):
-                    continue
-
-                # Build a 2D Grid of the piano keys being played
-                # • Coordinate: (Note, #offset) @ (Start, End, Channel, Velocity)
-                if (simultaneous < MAX_ROLLING):
-                    roll[note.note, simultaneous] = (note.start, note.end, note.channel, note.velocity)
-                    simultaneous += 1
-
-                # Skip non-playing notes
-                if not (note.start <= time <= note.end):
-                    continue
-
-                # Workaround: Don't play the full note, so close notes velocities are perceived twice
-                _note_too_small = (note.end - note.start) < self.release_before_end
-                _shorter_note = (time < (note.end - self.release_before_end))
-
-                if (_shorter_note or _note_too_small):
-                    self.key_press_dynamics.target[midi] = note.velocity
-
-                # Either way, the channel must be colored
-                channels[0][midi] = note.channel
-
-                # Find empty slots or notes that will end soon, replace and play
-                other = self._playing_matrix[midi][note.channel]
-                if (other is None) or (other.end > note.end):
-                    play_velocity = int(128*((note.velocity/128)**0.5))
-                    self.fluid_key_down(midi, play_velocity, note.channel)
-                    self._playing_matrix[midi][note.channel] = note
-
-            # Find notes that are not being played
-            for channel in range(MAX_CHANNELS * self.scene.realtime):
-                if (other := self._playing_matrix[midi][channel]) and (other.end < time):
-                    self._playing_matrix[midi][channel] = None
-                    self.fluid_key_up(midi, other.channel)
+        channels = self._channels_next
+        channels.fill(-1)
+
+        # All notes overlapping the lookup window, in start order
+        upcoming = store.between(time, time+self.lookup_time)
+        pitches  = store.note[upcoming]
+        rows     = self._build_roll(upcoming, time)
+
+        # Notes being played right now
+        playing = upcoming[store.start[upcoming] <= time]
+        start, end = (store.start[playing], store.end[playing])
+        note, channel, velocity = (store.note[playing], store.channel[playing], store.velocity[playing])
+
+        # Workaround: Don't play the full note, so close notes velocities are perceived twice
+        _note_too_small = (end - start) < self.release_before_end
+        _shorter_note = (time < (end - self.release_before_end))
+        pressed = (_shorter_note | _note_too_small)
+        self.key_press_dynamics.target[note[pressed]] = velocity[pressed]
+
+        # Either way, the channel must be colored
+        channels[0][note] = channel
+
+        # Find empty slots or notes that will end soon, replace and play
+        for index in np.flatnonzero(~(self._playing_matrix[note, channel] <= end)):
+            midi, chan = int(note[index]), int(channel[index])
+            other = self._playing_matrix[midi, chan]
+            if np.isnan(other) or (other > end[index]):
+                play_velocity = int(128*((velocity[index]/128)**0.5))
+                self.fluid_key_down(midi, play_velocity, chan)
+                self._playing_matrix[midi, chan] = end[index]
+
+        # Find notes that are not being played
+        for midi, chan in zip(*np.nonzero(self._playing_matrix < time)):
+            self._playing_matrix[midi, chan] = np.nan
+            self.fluid_key_up(int(midi), int(chan))
 
         # Dynamic zoom velocity based on future lookup
         self.note_range_dynamics.frequency = 0.5/self.lookup_time
@@ -265,16 +326,22 @@ class ShaderPiano(ShaderModule):
 
         # Set new targets for dynamic keys
         self.note_range_dynamics.target[:] = (
-            min(upcoming, default=self.global_minimum_note),
-            max(upcoming, default=self.global_maximum_note)
+            (pitches.min(), pitches.max()) if len(pitches) else
+            (self.global_minimum_note, self.global_maximum_note)
         )
 
         # Write to keys textures
         self.note_range_dynamics.next(dt=abs(self.scene.dt))
         self.key_press_dynamics.next(dt=abs(self.scene.dt))
         self.keys_texture.write(data=self.key_press_dynamics.value)
-        self.roll_texture.write(data=roll)
-        self.channel_texture.write(data=channels)
+
+        # Only upload what changed since the last frame
+        self._write_rows(self.roll_texture, self._roll_next, rows)
+        self._roll, self._roll_next = (self._roll_next, self._roll)
+        self._roll_depth.reverse()
+        if not np.array_equal(channels, self._channels):
+            self.channel_texture.write(data=channels)
+            self._channels, self._channels_next = (channels, self._channels)
 
     def pipeline(self) -> Iterable[ShaderVariable]:
         yield Uniform("int",   f"{self.name}GlobalMin",  self.global_minimum_note)
@@ -291,6 +358,12 @@ class ShaderPiano(ShaderModule):
     fluidsynth: Any = None
     soundfont:  Any = None
 
+    soundfont_file: Optional[Path] = None
+    """Path of the loaded soundfont, for synthesizing exports' audio"""
+
+    _programs: dict[int, tuple[int, int]] = Factory(dict)
+    """Selected (bank, preset) of each channel"""
+
     @staticmethod
     def fluid_install() -> None:
         if not shutil.which("fluidsynth"):
@@ -306,11 +379,13 @@ class ShaderPiano(ShaderModule):
         self.fluidsynth.start()
 
     def fluid_load(self, soundfont: Path) -> None:
+        self.soundfont_file = Path(soundfont)
         self.soundfont = self.fluidsynth.sfload(str(soundfont))
         for channel in range(MAX_CHANNELS):
             self.fluid_select(channel, 0, 0)
 
     def fluid_select(self, channel: int=0, bank: int=0, preset: int=0) -> None:
+        self._programs[channel] = (bank, preset)
         if self.fluidsynth and self.scene.realtime:
             self.fluidsynth.program_select(channel, self.soundfont, bank, preset)
 
@@ -326,3 +401,147 @@ class ShaderPiano(ShaderModule):
         if self.fluidsynth and self.scene.realtime:
             for channel, note in itertools.product(range(MAX_CHANNELS), range(MAX_NOTE)):
                 self.fluidsynth.noteoff(channel, note)
+
+    # # Offline synthesis
+
+    offline: bool = True
+    """Synthesize the notes into the exported video's audio, as realtime playback is muted"""
+
+    samplerate: int = 44100
+    """Samplerate of the synthesized audio"""
+
+    block: int = 2**16
+    """Number of samples per write of the synthesized audio"""
+
+    _synthesis: Optional[Path] = None
+    """Temporary directory of the synthesized audio file or named pipe"""
+
+    _synthesizer: Optional[Thread] = None
+    """Thread streaming the synthesized audio into the named pipe"""
+
+    _cancel: Event = Factory(Event)
+    """Stops the current synthesis thread"""
+
+    def stop_synthesis(self) -> None:
+        """Stop a previous export's synthesis, removing its named pipe and temporary directory"""
+        if (self._synthesis is None):
+            return None
+        self._cancel.set()
+
+        # Hold a reader open until the writer leaves, it might not have opened the pipe yet,
+        # and drain it as a write might be blocked on a pipe FFmpeg stopped reading
+        if (self._synthesizer is not None) and self._synthesizer.is_alive():
+            reader = os.open(self._synthesis/"audio.pcm", os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                for _ in range(500):
+                    with contextlib.suppress(BlockingIOError):
+                        os.read(reader, 2**16)
+                    self._synthesizer.join(timeout=0.01)
+                    if not self._synthesizer.is_alive():
+                        break
+            finally:
+                os.close(reader)
+
+        shutil.rmtree(self._synthesis, ignore_errors=True)
+        self._synthesis = self._synthesizer = None
+
+    def ffhook(self, ffmpeg: FFmpeg) -> None:
+        self.stop_synthesis()
+        if not (self.offline and self.soundfont_file and len(self.store)):
+            return None
+        if (self.scene.speed <= 0):
+            logger.warn("Can't synthesize piano audio with non-positive speeds")
+            return None
+        try:
+            import fluidsynth  # noqa: F401
+        except ImportError:
+            return self.fluid_install()
+
+        self._synthesis = Path(tempfile.mkdtemp(prefix="shaderflow-piano-"))
+        self._cancel = Event()
+        path  = (self._synthesis/"audio.pcm")
+        total = round(self.scene.runtime * self.samplerate)
+
+        # Stream to FFmpeg ahead of the renderer, or fully synthesize without named pipes
+        if hasattr(os, "mkfifo"):
+            os.mkfifo(path)
+            self._synthesizer = Thread(target=self._synthesize, args=(path, total, self._cancel), daemon=True)
+            self._synthesizer.start()
+        else:
+            self._synthesize(path, total, self._cancel)
+
+        ffmpeg.pcm_input(path=path, format="s16le", samplerate=self.samplerate, channels=2)
+        ffmpeg.mix = True
+
+    def _events(self, total: int) -> Iterable[tuple[int, bool, int, int, int]]:
+        """Time sorted (sample, on, note, channel, velocity) events of the notes, offs first"""
+        store = self.store
+        scale = (self.samplerate / self.scene.speed)
+        on    = np.round((store.start - self.time_offset) * scale).astype(np.int64)
+        off   = np.round((store.end   - self.time_offset) * scale).astype(np.int64)
+        on, off = (np.clip(on, 0, total), np.clip(off, 0, total))
+        keep  = (on < off)
+        on, off = (on[keep], off[keep])
+        note, channel = (store.note[keep], store.channel[keep])
+        velocity = np.minimum(127, (128*((store.velocity[keep]/128)**0.5)).astype(np.int64))
+
+        sample = np.concatenate((off, on))
+        kind   = np.repeat((False, True), len(on))
+        order  = np.lexsort((kind, sample))
+        yield from zip(
+            sample[order].tolist(), kind[order].tolist(),
+            np.tile(note, 2)[order].tolist(), np.tile(channel, 2)[order].tolist(),
+            np.tile(velocity, 2)[order].tolist(),
+        )
+
+    def _synthesize(self, path: Path, total: int, cancel: Event) -> None:
+        """Render the notes with fluidsynth's offline synthesis into a raw s16le stereo file"""
+        import fluidsynth
+        synth = fluidsynth.Synth(samplerate=float(self.samplerate))
+        synth.setting("synth.gain", 1.2)
+        soundfont = synth.sfload(str(self.soundfont_file))
+        for channel in range(MAX_CHANNELS):
+            synth.program_select(channel, soundfont, *self._programs.get(channel, (0, 0)))
+
+        # Overlapping notes on the same key are released by the last one only
+        active: dict[tuple[int, int], int] = dict()
+        chunks, pending, cursor = (list(), 0, 0)
+
+        def render(file: BinaryIO, until: int) -> None:
+            nonlocal pending, cursor
+            if cancel.is_set():
+                raise InterruptedError
+            if (until > cursor):
+                chunks.append(synth.get_samples(until - cursor))
+                pending += (until - cursor)
+                cursor = until
+            if chunks and ((pending >= self.block) or (cursor >= total)):
+                file.write(np.concatenate(chunks).astype(np.int16).tobytes())
+                chunks.clear()
+                pending = 0
+
+        try:
+            with open(path, "wb") as file:
+                for sample, on, note, channel, velocity in self._events(total):
+                    render(file, sample)
+                    key = (note, channel)
+                    if on:
+                        active[key] = active.get(key, 0) + 1
+                        synth.noteon(channel, note, velocity)
+                    elif (active[key] == 1):
+                        active.pop(key)
+                        synth.noteoff(channel, note)
+                    else:
+                        active[key] -= 1
+                for start in range(cursor, total + 1, self.block):
+                    render(file, min(start + self.block, total))
+        except BrokenPipeError:
+            if (not cancel.is_set()):
+                logger.warn("FFmpeg closed the piano audio pipe before the end")
+        except InterruptedError:
+            pass
+        finally:
+            synth.delete()
+
+    def destroy(self) -> None:
+        self.stop_synthesis()
@@ -1,8 +1,10 @@
 import functools
 import math
-from typing import Any, Self
+from collections.abc import Iterable
+from typing import Any, Optional, Self
 
-from attrs import define
+import numpy as np
+from attrs import Factory, define
 
 PIANO_NOTES = "C C# D D# E F F# G G# A A# B".split()
 
@@ -122,3 +124,151 @@ class PianoNote:
     @duration.setter
     def duration(self, value: float):
         self.end = self.start + value
+
+# ---------------------------------------------------------------------------- #
+
+@define(eq=False)
+class PianoNotes:
+    """
+    Columnar storage of many notes as arrays sorted by start time, with an interval index for
+    finding all notes overlapping a time range in O(b log n + k), for b duration buckets:
+
+    - Notes are grouped by power of two duration buckets, each sorted by start time
+    - Within a bucket of longest duration L, overlapping notes start in [start - L, end],
+      found by two binary searches. As all durations are within half of L, the non-overlapping
+      ones scanned are bounded by the bucket's notes playing at the range's start, so a long
+      note only widens the scan of its own bucket, not of every other note
+    """
+    start:    np.ndarray = Factory(lambda: np.empty(0, dtype=np.float64))
+    end:      np.ndarray = Factory(lambda: np.empty(0, dtype=np.float64))
+    note:     np.ndarray = Factory(lambda: np.empty(0, dtype=np.int16))
+    channel:  np.ndarray = Factory(lambda: np.empty(0, dtype=np.int16))
+    velocity: np.ndarray = Factory(lambda: np.empty(0, dtype=np.int16))
+
+    _order: np.ndarray = Factory(lambda: np.empty(0, dtype=np.int64))
+    """Note indices grouped by duration bucket, each group sorted by start time"""
+
+    _keys: np.ndarray = Factory(lambda: np.empty(0, dtype=np.float64))
+    """Start times in `_order` offset by `_span` per bucket, for searching all buckets at once"""
+
+    _first: float = 0.0
+    """Earliest start time, the keys' origin"""
+
+    _span: float = 0.0
+    """Distance between buckets' keys, wider than the start times' range"""
+
+    _longest: np.ndarray = Factory(lambda: np.empty(0, dtype=np.float64))
+    """Longest duration of each bucket"""
+
+    duration: float = 0.0
+    """End time of the last note to finish"""
+
+    lowest: Optional[int] = None
+    """Lowest note index, None if empty"""
+
+    highest: Optional[int] = None
+    """Highest note index, None if empty"""
+
+    softest: Optional[int] = None
+    """Minimum velocity, None if empty"""
+
+    loudest: Optional[int] = None
+    """Maximum velocity, None if empty"""
+
+    _pending: list[tuple] = Factory(list)
+    """Notes added but not yet merged into the sorted arrays"""
+
+    COLUMNS = ("start", "end", "note", "channel", "velocity")
+
+    def __len__(self) -> int:
+        self.commit()
+        return len(self.start)
+
+    def clear(self) -> None:
+        self._pending.clear()
+        for name in self.COLUMNS:
+            setattr(self, name, getattr(self, name)[:0])
+        self.sort()
+
+    def add(self, note: PianoNote) -> None:
+        self._pending.append((note.start, note.end, note.note, note.channel, note.velocity))
+
+    def extend(self, **columns: np.ndarray) -> None:
+        """Add many notes at once from arrays of each column"""
+        self.commit()
+        for name in self.COLUMNS:
+            setattr(self, name, np.concatenate((getattr(self, name), columns[name])).astype(getattr(self, name).dtype))
+        self.sort()
+
+    def commit(self) -> None:
+        if (not self._pending):
+            return None
+        pending = np.array(self._pending, dtype=np.float64).T
+        self._pending.clear()
+        self.extend(**dict(zip(self.COLUMNS, pending)))
+
+    def sort(self) -> None:
+        order = np.argsort(self.start, kind="stable")
+        for name in self.COLUMNS:
+            setattr(self, name, getattr(self, name)[order])
+        self.index()
+        self.measure()
+
+    def index(self) -> None:
+        """Rebuild the interval index, call after editing the start or end times in-place"""
+        duration = np.maximum(self.end - self.start, 0.0)
+        _, bucket = np.unique(np.frexp(duration)[1], return_inverse=True)
+        self._order = np.lexsort((self.start, bucket))
+        bucket = bucket[self._order]
+        if (not len(bucket)):
+            self._keys = self._longest = np.empty(0, dtype=np.float64)
+            return None
+        self._longest = np.zeros(bucket[-1] + 1, dtype=np.float64)
+        np.maximum.at(self._longest, bucket, duration[self._order])
+        self._first = float(self.start.min())
+        self._span  = float(self.start.max() - self._first) + 2.0
+        self._keys  = (bucket * self._span) + (self.start[self._order] - self._first)
+
+    def measure(self) -> None:
+        """Update the summary statistics, call after editing the columns in-place"""
+        if (not len(self.start)):
+            self.duration = 0.0
+            self.lowest = self.highest = self.softest = self.loudest = None
+            return None
+        self.duration = float(self.end.max())
+        self.lowest,  self.highest = (int(self.note.min()), int(self.note.max()))
+        self.softest, self.loudest = (int(self.velocity.min()), int(self.velocity.max()))
+
+    def between(self, start: float, end: float) -> np.ndarray:
+        """Indices of the notes overlapping [start, end], sorted by start time"""
+        self.commit()
+        if (not len(self._order)):
+            return np.empty(0, dtype=np.int64)
+
+        # Search each bucket's range [start - longest, end] of start times at once
+        offset = (np.arange(len(self._longest)) * self._span)
+        lower  = np.clip(start - self._first - self._longest - 1e-9, -1.0, self._span - 1.0)
+        upper  = np.clip(end - self._first, -1.0, self._span - 1.0)
+        lower  = np.searchsorted(self._keys, offset + lower, side="left")
+        upper  = np.searchsorted(self._keys, offset + upper, side="right")
+
+        # Concatenate the ranges, keep the actually overlapping notes
+        counts = (upper - lower)
+        found  = np.repeat(lower - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        found  = self._order[found]
+        found  = found[(self.end[found] >= start) & (self.start[found] <= end)]
+        found.sort()
+        return found
+
+    def get(self, index: int) -> PianoNote:
+        return PianoNote(
+            start=float(self.start[index]),
+            end=float(self.end[index]),
+            note=int(self.note[index]),
+            channel=int(self.channel[index]),
+            velocity=int(self.velocity[index]),
+        )
+
+    def __iter__(self) -> Iterable[PianoNote]:
+        for index in range(len(self)):
+            yield self.get(index)
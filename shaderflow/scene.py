@@ -21,8 +21,10 @@ from parsenaut._cyclopts import Launcher
 import shaderflow
 from shaderflow import logger
 from shaderflow.camera import ShaderCamera
+from shaderflow.dynamics import DynamicsSolver, ShaderDynamics
 from shaderflow.exporting import ExportingHelper
 from shaderflow.ffmpeg import FFmpeg
+from shaderflow.fourier import BrokenFourier, FourierBackend
 from shaderflow.frametimer import ShaderFrametimer
 from shaderflow.keyboard import ShaderKeyboard
 from shaderflow.message import ShaderMessage
@@ -94,6 +96,9 @@ class ShaderScene(ShaderModule):
     camera: ShaderCamera = None # type: ignore
     """Default Camera module"""
 
+    solver: DynamicsSolver = None # type: ignore
+    """Steps all the real valued dynamics modules at once"""
+
     shader: ShaderProgram = None # type: ignore
     """The main shader of the scene"""
 
@@ -132,6 +137,7 @@ class ShaderScene(ShaderModule):
         logger.info(f"Initializing scene {self.name} with backend {self.backend}")
 
         # Default modules
+        self.solver = DynamicsSolver(scene=self)
         self.frametimer = ShaderFrametimer(scene=self)
         self.keyboard = ShaderKeyboard(scene=self)
         self.camera = ShaderCamera(scene=self)
@@ -263,6 +269,18 @@ class ShaderScene(ShaderModule):
     def frame(self, value: int):
         self.time = (value / self.fps)
 
+    def seek(self, time: float) -> None:
+        """
+        Jump to a time, advancing scene time dynamics analytically instead of every frame
+
+        Note: Backward seeks leave the dynamics as they are, the systems can't be rewound
+        """
+        if (time > self.time):
+            for module in self.find(ShaderDynamics):
+                if (not module.real):
+                    module.advance(time - self.time)
+        self.time = time
+
     # Total Duration
 
     @property
@@ -463,8 +481,10 @@ class ShaderScene(ShaderModule):
 
         # Update in reverse order of addition (child -> parent -> root)
         # Update non-shader first, as the pipeline might change
-        for module in self.modules:
+        self.solver.prepare()
+        for index, module in enumerate(self.modules):
             if not isinstance(module, ShaderProgram):
+                self.solver.step(index)
                 module.update()
         for module in reversed(self.modules):
             if isinstance(module, ShaderProgram):
@@ -551,6 +571,10 @@ class ShaderScene(ShaderModule):
             help="Send raw OpenGL frames before GPU SSAA to FFmpeg (CPU Downsampling)",
             group="🔵 Special", negative="")] = False,
 
+        fft: Annotated[Optional[FourierBackend], Parameter(
+            help="FFT backend of audio modules (None to find the fastest available)",
+            group="🔵 Special")] = None,
+
         turbo: Annotated[bool, Parameter(
             help="Fast data transfers to FFmpeg (disabling may fix segfaults in some systems)",
             group="🔵 TurboPipe")] = True,
@@ -572,6 +596,7 @@ class ShaderScene(ShaderModule):
         self.speed      = (speed)
         self.fps        = (fps)
         self.time       = 0
+        BrokenFourier.preferred = (fft)
         self.relay(ShaderMessage.Shader.Compile)
         self.scheduler.clear()
 
@@ -832,7 +857,7 @@ class ShaderScene(ShaderModule):
 
         # Time Travel on Alt
         elif self.keyboard(ShaderKeyboard.Keys.LEFT_ALT):
-            self.time -= self._mouse_drag_time_factor * (dy/self.height)
+            self.seek(self.time - self._mouse_drag_time_factor * (dy/self.height))
             return
 
         self.relay(ShaderMessage.Mouse.Drag(
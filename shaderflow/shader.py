@@ -378,7 +378,7 @@ class ShaderProgram(ShaderModule):
         for variable in pipeline:
             # if variable not in self.fragment_variables:
             #     self.load_shaders()
-            if (variable.type == "sampler2D"):
+            if ("sampler" in variable.type):
                 self.set_uniform(variable.name, _index)
                 variable.value.use(_index)
                 _index += 1
@@ -24,7 +24,6 @@ def pop_fill(data: Collection, fill: type, length: int) -> Collection:
         data.append(fill())
     return data
 
-# Fixme: usampler2D, isampler2D?
 def numpy2mgltype(type: Union[np.dtype, str]) -> str:
     if isinstance(type, str):
         return type
@@ -33,10 +32,18 @@ def numpy2mgltype(type: Union[np.dtype, str]) -> str:
     return {
         np.uint8:   "f1",
         np.uint16:  "u2",
+        np.uint32:  "u4",
+        np.int8:    "i1",
+        np.int16:   "i2",
+        np.int32:   "i4",
         np.float16: "f2",
         np.float32: "f4",
     }.get(type)
 
+def mgltype2sampler(type: str) -> str:
+    """Sampler prefix for a moderngl dtype, integer textures can't be read as floats"""
+    return dict(u="usampler", i="isampler").get(type[0], "sampler")
+
 
 # Fixme: Disallow bad combinations of filter and types
 class TextureFilter(Enum):
@@ -44,6 +51,19 @@ class TextureFilter(Enum):
     Linear  = "linear"
 
 
+class TextureStorage(Enum):
+    """How the texture matrix boxes are stored on the GPU"""
+
+    Texture2D = "texture2d"
+    """One sampler2D texture and framebuffer per box, renderable by shaders"""
+
+    Array = "texture_array"
+    """A single sampler2DArray with one slice per box, for data textures"""
+
+    Texture3D = "texture3d"
+    """One sampler3D volumetric texture per box of `depth` slices, for data textures"""
+
+
 class Anisotropy(Enum):
     x1  = 1
     x2  = 2
@@ -59,10 +79,14 @@ class TextureBox:
     data:    bytes = field(default=None, repr=False)
     clear:   bool  = False
     empty:   bool  = True
+    index:   int   = 0
+    """Slice of the shared texture this box points to, on array storage"""
 
     def release(self) -> None:
-        with contextlib.suppress(Exception):
-            self.texture.release()
+        # Note: Array boxes share a texture, released once by the owner
+        if (self.index == 0):
+            with contextlib.suppress(Exception):
+                self.texture.release()
         with contextlib.suppress(Exception):
             self.fbo.release()
 
@@ -122,13 +146,19 @@ class ShaderTexture(ShaderModule):
     repeat_y: bool = field(default=True, converter=bool, on_setattr=__apply__)
     """Should the texture repeat on the Y axis when out of bounds or clamp"""
 
+    repeat_z: bool = field(default=True, converter=bool, on_setattr=__apply__)
+    """Should the texture repeat on the Z axis when out of bounds or clamp (Texture3D only)"""
+
     def repeat(self, value: bool) -> Self:
-        """Syntatic sugar for setting both repeat_x and repeat_y"""
-        self.repeat_x = self.repeat_y = bool(value)
+        """Syntatic sugar for setting all repeat_x, repeat_y and repeat_z"""
+        self.repeat_x = self.repeat_y = self.repeat_z = bool(value)
         return self.apply()
 
     @property
     def moderngl_filter(self) -> int:
+        # Note: Integer textures are incomplete with any filtering
+        if self.integer:
+            return moderngl.NEAREST
         return dict(
             linear=moderngl.LINEAR,
             nearest=moderngl.NEAREST,
@@ -181,6 +211,40 @@ class ShaderTexture(ShaderModule):
         on_setattr=__make__)
     """Data type of the texture for each pixel channel"""
 
+    storage: TextureStorage = field(
+        default=TextureStorage.Texture2D,
+        converter=TextureStorage,
+        on_setattr=__make__)
+    """How the boxes are stored on the GPU, only Texture2D can be rendered to"""
+
+    depth: int = field(default=1, converter=int, on_setattr=__make__)
+    """Number of slices of each box on Texture3D storage"""
+
+    @property
+    def mgltype(self) -> str:
+        return numpy2mgltype(self.dtype)
+
+    @property
+    def integer(self) -> bool:
+        """Integer textures are sampled with usampler/isampler and can't be filtered"""
+        return (self.mgltype[0] in "ui")
+
+    @property
+    def sampler(self) -> str:
+        return mgltype2sampler(self.mgltype) + {
+            TextureStorage.Texture2D: "2D",
+            TextureStorage.Array:     "2DArray",
+            TextureStorage.Texture3D: "3D",
+        }[self.storage]
+
+    @property
+    def volumetric(self) -> bool:
+        return (self.storage is TextureStorage.Texture3D)
+
+    @property
+    def array(self) -> bool:
+        return (self.storage is TextureStorage.Array)
+
     @property
     def resolution(self) -> tuple[int, int]:
         if not self.track:
@@ -212,7 +276,7 @@ class ShaderTexture(ShaderModule):
 
     @property
     def zeros(self) -> np.ndarray:
-        return np.zeros((*self.size, self.components), dtype=self.dtype)
+        return np.zeros((*((self.depth,)*self.volumetric), *self.size, self.components), dtype=self.dtype)
 
     @property
     def bytes_per_pixel(self) -> int:
@@ -220,8 +284,8 @@ class ShaderTexture(ShaderModule):
 
     @property
     def size_t(self) -> int:
-        """Size of the texture data in bytes"""
-        return (self.width * self.height * self.bytes_per_pixel)
+        """Size of the texture data in bytes (of a single box)"""
+        return (self.width * self.height * self.bytes_per_pixel) * (self.depth if self.volumetric else 1)
 
     def new_buffer(self) -> moderngl.Buffer:
         """Make a new buffer with the current size of the texture"""
@@ -247,39 +311,76 @@ class ShaderTexture(ShaderModule):
     def row(self, n: int=0) -> Iterable[TextureBox]:
         yield from self.matrix[n]
 
+    @property
+    def textures(self) -> Iterable[moderngl.Texture]:
+        """Unique textures of all boxes, array storage shares a single one"""
+        yield from {id(box.texture): box.texture for (_, _, box) in self.boxes}.values()
+
     def make(self) -> Self:
-        if (max(self.size) > (limit := self.scene.opengl.info['GL_MAX_VIEWPORT_DIMS'][0])):
+        info = self.scene.opengl.info
+
+        if (max(self.size) > (limit := info['GL_MAX_VIEWPORT_DIMS'][0])):
             raise Exception(f"Texture size too large for this OpenGL context: {self.size} > {limit}")
+        if self.array and ((slices := self.temporal*self.layers) > (limit := info.get('GL_MAX_ARRAY_TEXTURE_LAYERS', slices))):
+            raise Exception(f"Texture array slices too many for this OpenGL context: {slices} > {limit}")
+        if self.volumetric and (max(*self.size, self.depth) > (limit := info.get('GL_MAX_3D_TEXTURE_SIZE', self.depth))):
+            raise Exception(f"Texture3D size too large for this OpenGL context: {(*self.size, self.depth)} > {limit}")
 
         # Populate the matrix with current size
         for row in pop_fill(self.matrix, deque, self.temporal):
             pop_fill(row, TextureBox, self.layers)
 
-        # Recreate texture boxes
+        # Release before recreating, as array boxes shares a texture
         for (_, _, box) in self.boxes:
             box.release()
-            box.texture = self.scene.opengl.texture(
+
+        # A single texture with one slice per box, indexed (temporal, layer)
+        if self.array:
+            shared = self.scene.opengl.texture_array(
                 components=self.components,
-                dtype=numpy2mgltype(self.dtype),
-                size=self.size)
-            box.fbo = self.scene.opengl.framebuffer(
-                color_attachments=[box.texture])
+                dtype=self.mgltype,
+                size=(*self.size, self.temporal*self.layers))
+
+        # Recreate texture boxes
+        for (it, ib, box) in self.boxes:
+            if self.array:
+                box.index   = (it*self.layers + ib)
+                box.texture = shared
+                box.fbo     = None
+            elif self.volumetric:
+                box.index   = 0
+                box.texture = self.scene.opengl.texture3d(
+                    components=self.components,
+                    dtype=self.mgltype,
+                    size=(*self.size, self.depth))
+                box.fbo = None
+            else:
+                box.index   = 0
+                box.texture = self.scene.opengl.texture(
+                    components=self.components,
+                    dtype=self.mgltype,
+                    size=self.size)
+                box.fbo = self.scene.opengl.framebuffer(
+                    color_attachments=[box.texture])
 
             # Rewrite previous data if same size
             if box.data and (self.size_t == len(box.data)):
-                box.texture.write(box.data)
+                box.texture.write(box.data, viewport=self._viewport(box))
 
         return self.apply()
 
     def apply(self) -> Self:
         """Apply filters and flags to all textures"""
-        for (_, _, box) in self.boxes:
+        for texture in self.textures:
             if self.mipmaps:
-                box.texture.build_mipmaps()
-            box.texture.filter     = (self.moderngl_filter, self.moderngl_filter)
-            box.texture.anisotropy = self.anisotropy.value
-            box.texture.repeat_x   = self.repeat_x
-            box.texture.repeat_y   = self.repeat_y
+                texture.build_mipmaps()
+            texture.filter   = (self.moderngl_filter, self.moderngl_filter)
+            texture.repeat_x = self.repeat_x
+            texture.repeat_y = self.repeat_y
+            if self.volumetric:
+                texture.repeat_z = self.repeat_z
+            else:
+                texture.anisotropy = self.anisotropy.value
         return self
 
     def destroy(self) -> None:
@@ -307,31 +408,89 @@ class ShaderTexture(ShaderModule):
         self.matrix.rotate(n)
         return self
 
+    @property
+    def head(self) -> int:
+        """Physical temporal slice of the most recent frame, on array storage"""
+        return (self.get_box(0, 0).index // self.layers)
+
     # -------------------------------------------|
     # Input and Output
 
+    def _viewport(self, box: TextureBox, viewport: tuple[int, ...]=None) -> Optional[tuple[int, ...]]:
+        """Convert a (x, y, width, height) viewport into the storage's own"""
+        if self.array:
+            x, y, width, height = (viewport or (0, 0, *self.size))
+            return (x, y, box.index, width, height, 1)
+        if self.volumetric and (viewport is not None) and (len(viewport) == 4):
+            x, y, width, height = viewport
+            return (x, y, 0, width, height, self.depth)
+        return viewport
+
     def write(self,
         data: bytes=None,
         *,
         temporal: int=0,
         layer: int=-1,
-        viewport: tuple[int, int, int, int]=None,
+        viewport: tuple[int, ...]=None,
     ) -> Self:
+        """
+        Upload data to a box of the texture, optionally on a sub-region
+
+        Args:
+            data: Raw bytes or a contiguous numpy array matching the viewport size
+
+            viewport: Region (x, y, width, height) to write, full box if None. Texture3D storage
+                also accepts (x, y, z, width, height, depth) for partial volume uploads
+        """
         box = self.get_box(temporal, layer)
-        box.texture.write(data, viewport=viewport)
+        box.texture.write(data, viewport=self._viewport(box, viewport))
         if (not viewport):
             box.data = bytes(data)
         box.empty = False
         return self
 
+    def write_slice(self, data: bytes, index: int, *, temporal: int=0, layer: int=-1) -> Self:
+        """Upload a single depth slice of a Texture3D box"""
+        return self.write(data, temporal=temporal, layer=layer, viewport=(0, 0, index, *self.size, 1))
+
     def from_numpy(self, data: np.ndarray) -> Self:
+        """
+        Make the texture from a numpy array of shape:
+        - Texture2D: (height, width) or (height, width, components)
+        - Texture3D: (depth, height, width) or (depth, height, width, components)
+        - Array: (slices, height, width) or (slices, height, width, components), as layers
+
+        Note: 4D arrays on Texture2D storage are implicitly converted to Array storage
+        """
+        if (numpy2mgltype(data.dtype) is None):
+            raise ValueError(f"Unsupported texture data type ({data.dtype})")
+        if (data.ndim == 4) and (self.storage is TextureStorage.Texture2D):
+            self.storage = TextureStorage.Array
+
+        # Slices are the first axis of volumes, components are optional last
+        slices = (self.storage is not TextureStorage.Texture2D)
         unpack = list(data.shape)
-        if len(unpack) == 2:
+        if len(unpack) == (2 + slices):
             unpack.append(1)
-        self._height, self._width, self.components = unpack
+        if slices:
+            depth, self._height, self._width, self.components = unpack
+        else:
+            self._height, self._width, self.components = unpack
         self.dtype = data.dtype
+
+        # Flip vertically to match OpenGL's bottom-left origin
+        data = np.flip(data.reshape(unpack), axis=-3)
+
+        if self.array:
+            self.temporal, self.layers = (1, depth)
+            self.make()
+            for layer, content in enumerate(data):
+                self.write(content.tobytes(), layer=layer)
+            return self
+        if self.volumetric:
+            self.depth = depth
         self.make()
-        self.write(np.flipud(data).tobytes())
+        self.write(data.tobytes())
         return self
 
     def from_image(self, image: ImageType) -> Self:
@@ -355,15 +514,27 @@ class ShaderTexture(ShaderModule):
         if not self.name:
             return
 
+        # Integer samplers returns uvec4 or ivec4
+        cast = ("vec4" if self.integer else "")
+
+        # Array storage is a single sampler, slices indexed by the rolling head
+        if self.array:
+            yield f"vec4 {self.name}Texture(int temporal, int layer, vec2 astuv) {{"
+            yield f"    int slice = ((temporal + {self.name}Head) % {self.name}Temporal)*{self.name}Layers + layer;"
+            yield f"    return {cast}(texture({self.name}, vec3(astuv, slice)));"
+            yield "}"
+            return
+
         # Define last frames as plain name (iTex0x(-1) -> iTex, iTex1x(-1) -> iTex1)
         for temporal in range(self.temporal):
             yield f"#define {self.name}{temporal or ''} {self.name}{temporal}x{self.layers-1}"
 
         # Get a texture handle from a temporal and layer
-        yield f"vec4 {self.name}Texture(int temporal, int layer, vec2 astuv) {{"
+        coords = ("vec3 uvw" if self.volumetric else "vec2 astuv")
+        yield f"vec4 {self.name}Texture(int temporal, int layer, {coords}) {{"
         for (temporal, layer) in itertools.product(range(self.temporal), range(self.layers)):
             yield f"    if (temporal == {temporal} && layer == {layer})"
-            yield f"        return texture({self._coord2name(temporal, layer)}, astuv);"
+            yield f"        return {cast}(texture({self._coord2name(temporal, layer)}, {coords.split()[1]}));"
         yield "    return vec4(0.0);"
         yield "}"
 
@@ -377,6 +548,12 @@ class ShaderTexture(ShaderModule):
         yield Uniform("vec2",  f"{self.name}Size",     self.size)
         yield Uniform("int",   f"{self.name}Layers",   self.layers)
         yield Uniform("int",   f"{self.name}Temporal", self.temporal)
+        if self.volumetric:
+            yield Uniform("int", f"{self.name}Depth", self.depth)
+        if self.array:
+            yield Uniform("int", f"{self.name}Head", self.head)
+            yield Uniform(self.sampler, self.name, self.texture)
+            return
         for (it, ib, box) in self.boxes:
-            yield Uniform("sampler2D", self._coord2name(it, ib), box.texture)
+            yield Uniform(self.sampler, self._coord2name(it, ib), box.texture)
 
@@ -11,6 +11,14 @@ GlslQualifier = Literal[
 
 GlslType = Literal[
     "sampler2D",
+    "usampler2D",
+    "isampler2D",
+    "sampler2DArray",
+    "usampler2DArray",
+    "isampler2DArray",
+    "sampler3D",
+    "usampler3D",
+    "isampler3D",
     "float",
     "int",
     "bool",
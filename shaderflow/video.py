@@ -1,14 +1,253 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable
+from queue import Empty, Queue
+from subprocess import PIPE, Popen
+from typing import ClassVar, Iterable, Optional, Self
 
 import numpy as np
-from attrs import define
+from attrs import Factory, define, field
 
+from shaderflow import logger
 from shaderflow.ffmpeg import FFmpeg
 from shaderflow.module import ShaderModule
 from shaderflow.texture import ShaderTexture
 
 
+@define(eq=False)
+class BrokenVideoPool:
+    """
+    Threads shared by all video decoders for reading frames, and a global memory budget of the
+    frames decoded ahead, so many videos don't each cost a thread and unbounded memory
+    """
+
+    workers: int = field(factory=lambda: min(8, os.cpu_count() or 1))
+    """Maximum number of frames being read at once across all decoders"""
+
+    budget: int = (512 * 2**20)
+    """Maximum bytes of all decoders' frame buffers"""
+
+    used: int = 0
+    """Bytes of frame buffers currently given out"""
+
+    _executor: ThreadPoolExecutor = None
+    _lock: threading.Lock = Factory(threading.Lock)
+
+    def submit(self, task) -> None:
+        if (self._executor is None):
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="VideoDecoder")
+        self._executor.submit(task)
+
+    def allocate(self, size: int, wanted: int) -> int:
+        """Reserve up to `wanted` buffers of `size` bytes within the budget, at least one"""
+        with self._lock:
+            count = max(1, min(wanted, (self.budget - self.used) // size))
+            self.used += (count * size)
+        if (count < wanted):
+            logger.warn(f"Video memory budget reached, prefetching {count} of {wanted} frames")
+        return count
+
+    def free(self, size: int) -> None:
+        with self._lock:
+            self.used -= size
+
+
+@define(eq=False)
+class BrokenVideoDecoder:
+    """
+    Decodes a video's frames with FFmpeg on the shared pool's threads, up to `depth` frames ahead
+    of the consumer, reading straight into a fixed set of recycled buffers
+
+    Frames got must be given back with `release` once uploaded, decoding pauses while all buffers
+    are in use, bounding the memory to `depth` frames (or less, on the pool's budget)
+    """
+    path: Path
+    width: int
+    height: int
+
+    depth: int = 4
+    """Maximum number of frames decoded ahead"""
+
+    yuv: bool = False
+    """Decode to planar yuv420p instead of packed rgb24, half the bytes per frame"""
+
+    flip: bool = True
+    """Vertically flip the frames in FFmpeg, OpenGL textures' first row is the bottom"""
+
+    seek: float = 0.0
+    """Time in seconds to start decoding from"""
+
+    pool: ClassVar[BrokenVideoPool] = BrokenVideoPool()
+    """Shared threads and memory budget of all decoders"""
+
+    _free: Queue = None
+    """Buffers available for decoding into"""
+
+    _ready: Queue = None
+    """Decoded frames in order, a None marks the end of the stream"""
+
+    _process: Popen = None
+    _running: bool = False
+
+    _pumping: bool = False
+    """Whether a pool task is reading frames for this decoder"""
+
+    _condition: threading.Condition = Factory(threading.Condition)
+
+    _allocated: int = 0
+    """Bytes reserved from the pool's budget"""
+
+    frames: int = 0
+    """Number of frames got so far"""
+
+    stalls: int = 0
+    """Number of times the consumer had to wait for a frame"""
+
+    stalled: float = 0.0
+    """Total seconds the consumer waited for frames"""
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        if self.yuv:
+            return ((self.width*self.height*3)//2,)
+        return (self.height, self.width, 3)
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape))
+
+    def planes(self, frame: np.ndarray) -> Iterable[np.ndarray]:
+        """Views of a frame's (Y, U, V) planes if yuv, else the packed rgb frame itself"""
+        if (not self.yuv):
+            yield frame
+            return None
+        luma = (self.width*self.height)
+        yield frame[:luma].reshape(self.height, self.width)
+        for plane in np.split(frame[luma:], 2):
+            yield plane.reshape(self.height//2, self.width//2)
+
+    def start(self) -> Self:
+        self.close()
+        self._free  = Queue()
+        self._ready = Queue()
+        count = self.pool.allocate(self.nbytes, self.depth)
+        self._allocated = (count * self.nbytes)
+        for _ in range(count):
+            self._free.put(np.empty(self.shape, dtype=np.uint8))
+        ffmpeg = (FFmpeg(vsync="cfr")
+            .quiet()
+            .input(path=self.path, seek=(self.seek or None))
+            .scale(width=self.width, height=self.height)
+        )
+        if self.flip:
+            ffmpeg.vflip()
+        self._process = (ffmpeg
+            .rawvideo()
+            .no_audio()
+            .pipe_output(
+                pixel_format=("yuv420p" if self.yuv else "rgb24"),
+                format="rawvideo",
+            )
+        ).popen(stdout=PIPE)
+        self._running = True
+        self._schedule()
+        return self
+
+    def _schedule(self) -> None:
+        """Queue a pool task reading frames, unless one is already"""
+        with self._condition:
+            if (self._pumping or not self._running):
+                return None
+            self._pumping = True
+        self.pool.submit(self._pump)
+
+    def _pump(self) -> None:
+        """Read frames into all free buffers, then give the thread back to the pool"""
+        stdout = self._process.stdout
+        while True:
+            with self._condition:
+                if (not self._running) or self._free.empty():
+                    self._pumping = False
+                    self._condition.notify_all()
+                    return None
+                buffer = self._free.get_nowait()
+
+            if not self._read(stdout, buffer):
+                with self._condition:
+                    self._running = self._pumping = False
+                    self._ready.put(None)
+                    self._condition.notify_all()
+                return None
+
+            self._ready.put(buffer)
+
+    @staticmethod
+    def _read(stdout, buffer: np.ndarray) -> bool:
+        """Fill a buffer from the pipe, False on the end of the stream"""
+        view   = memoryview(buffer).cast("B")
+        filled = 0
+        try:
+            # Pipes may return partial reads
+            while (filled < len(view)):
+                if not (read := stdout.readinto(view[filled:])):
+                    return False
+                filled += read
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def get(self) -> Optional[np.ndarray]:
+        """The next frame, None at the end of the stream. Waits for the decoder if not ready"""
+        if (self._ready is None):
+            return None
+        try:
+            frame = self._ready.get_nowait()
+        except Empty:
+            start = time.perf_counter()
+            frame = self._ready.get()
+            self.stalled += (time.perf_counter() - start)
+            self.stalls += 1
+        if (frame is None):
+            self._ready.put(None)
+            return None
+        self.frames += 1
+        return frame
+
+    def release(self, frame: np.ndarray) -> None:
+        """Give back a frame's buffer for decoding into"""
+        self._free.put(frame)
+        self._schedule()
+
+    def skip(self, frames: int) -> None:
+        """Decode and drop a number of frames, cheaper than seeking when few"""
+        for _ in range(frames):
+            if (frame := self.get()) is None:
+                return None
+            self.release(frame)
+
+    def log_stats(self) -> None:
+        if self.stalls:
+            logger.info(f"Video decoder of ({self.path}) stalled {self.stalls} times for {self.stalled:.2f}s over {self.frames} frames")
+
+    def close(self) -> None:
+        if (self._process is None):
+            return None
+        with self._condition:
+            self._running = False
+        self._process.kill()
+        self._process.wait()
+
+        # Wait for a pool task reading this decoder, unblocked by the kill
+        with self._condition:
+            self._condition.wait_for(lambda: not self._pumping)
+        self.pool.free(self._allocated)
+        self._allocated = 0
+        self._process = None
+
+# ---------------------------------------------------------------------------- #
+
 @define
 class ShaderVideo(ShaderModule):
     name: str = "iVideo"
@@ -28,15 +267,46 @@ class ShaderVideo(ShaderModule):
     fps: float = None
     """Content framerate, auto calculated when None"""
 
-    _reader: Iterable = None
-    """Internal frames iterable"""
+    prefetch: int = 4
+    """Number of frames decoded ahead on a separate thread"""
+
+    yuv: bool = False
+    """Upload yuv420p planes instead of rgb24, half the bytes per frame. The (Y, U, V) planes are
+    the `{name}Y`, `{name}U`, `{name}V` textures, converted (BT.709) by `{name}Color(stuv)`.
+    Requires an even width and height"""
+
+    planes: list[ShaderTexture] = Factory(list)
+    """Textures written each frame, the rgb one or the three (Y, U, V) planes"""
+
+    loop: bool = False
+    """Repeat the video after its end, else hold the last frame"""
+
+    time_offset: float = 0.0
+    """Offset the video's time from the scene's"""
+
+    max_skip: int = 30
+    """Maximum frames behind to decode and drop, seek (restart the decoder) if more"""
+
+    rewind: int = 8
+    """Frames decoded at once and kept in memory when playing backwards, one seek per chunk"""
+
+    frames: int = None
+    """Total number of frames, from the probed duration"""
+
+    _decoder: BrokenVideoDecoder = None
+    """Internal threaded frames decoder"""
+
+    _frame: int = -1
+    """Index of the frame on the textures"""
+
+    _next: int = 0
+    """Index of the next frame the decoder returns"""
 
-    _frames: int = 0
-    """Number of frames read so far"""
+    _rewound: dict[int, np.ndarray] = Factory(dict)
+    """Copies of the last backwards chunk of frames, by index"""
 
     def __attrs_post_init__(self):
         ShaderModule.__attrs_post_init__(self)
-        self._reader = FFmpeg.iter_video_frames(self.path)
 
         # Find base video specifications
         if not all((self.width, self.height)):
@@ -44,23 +314,121 @@ class ShaderVideo(ShaderModule):
 
         self.fps = (self.fps or FFmpeg.get_video_framerate(self.path))
 
-        # Note: You can set .temporal
-        self.texture = ShaderTexture(
-            scene=self.scene,
-            name=self.name,
+        # Some containers don't store durations, count frames by decoding then
+        if (duration := FFmpeg.get_video_duration(self.path)) is not None:
+            self.frames = max(1, round(duration * self.fps))
+        else:
+            self.frames = max(1, FFmpeg.get_video_total_frames(self.path) or 1)
+
+        self._decoder = BrokenVideoDecoder(
+            path=self.path,
             width=self.width,
             height=self.height,
-            dtype=np.uint8,
-            components=3,
-        )
+            depth=self.prefetch,
+            yuv=self.yuv,
+        ).start()
+
+        # Note: You can set .temporal
+        if self.yuv:
+            self.planes = [
+                ShaderTexture(
+                    scene=self.scene,
+                    name=f"{self.name}{plane}",
+                    width=(self.width//scale),
+                    height=(self.height//scale),
+                    dtype=np.uint8,
+                    components=1,
+                ) for plane, scale in zip("YUV", (1, 2, 2))
+            ]
+        else:
+            self.planes = [ShaderTexture(
+                scene=self.scene,
+                name=self.name,
+                width=self.width,
+                height=self.height,
+                dtype=np.uint8,
+                components=3,
+            )]
+        self.texture = self.planes[0]
+
+    @property
+    def duration(self) -> float:
+        return 0.0 if self.loop else (self.frames / self.fps)
+
+    def frame_at(self, time: float) -> int:
+        """Index of the frame shown at a time, wrapped if looping or clamped to the ends"""
+        index = int((time + self.time_offset) * self.fps)
+        if self.loop:
+            return (index % self.frames)
+        return max(0, min(index, self.frames - 1))
+
+    def seek(self, index: int) -> None:
+        """Restart decoding at a frame index"""
+        self._decoder.seek = (index / self.fps)
+        self._decoder.start()
+        self._next = index
+
+    def rewind_to(self, index: int) -> None:
+        """Decode the chunk of `rewind` frames ending at an index, for stepping backwards"""
+        self._rewound.clear()
+        self.seek(start := max(0, index - self.rewind + 1))
+        for frame in range(start, index + 1):
+            if (buffer := self._decoder.get()) is None:
+                break
+            self._rewound[frame] = buffer.copy()
+            self._decoder.release(buffer)
+            self._next = (frame + 1)
+
+    def _show(self, buffer: np.ndarray, index: int) -> None:
+
+        # Note: A full viewport skips the texture's own bytes() copy of the data
+        for texture, plane in zip(self.planes, self._decoder.planes(buffer)):
+            texture.roll()
+            texture.write(plane, viewport=(0, 0, *texture.size))
+        self._frame = index
 
     def update(self) -> None:
+        if (index := self.frame_at(self.scene.time)) == self._frame:
+            return None
+
+        # Play backwards from chunks decoded ahead, instead of restarting every frame
+        if (index < self._next) and (0 < self._frame - index <= self.max_skip):
+            if (index not in self._rewound):
+                self.rewind_to(index)
+            if (buffer := self._rewound.get(index)) is not None:
+                self._show(buffer, index)
+                return None
+        self._rewound.clear()
+
+        # Catch up by dropping a few frames, or seek on large jumps
+        if 0 <= (behind := index - self._next) <= self.max_skip:
+            self._decoder.skip(behind)
+        else:
+            self.seek(index)
+
+        # Hold the last frame on early ends, as the probed duration isn't exact
+        if (buffer := self._decoder.get()) is None:
+            self._next = self._frame = index
+            return None
+
+        self._show(buffer, index)
+        self._decoder.release(buffer)
+        self._next = (index + 1)
+
+    def defines(self) -> Iterable[str]:
+
+        # Note: Samplers' short names are defined later by the textures
+        names = [texture._coord2name(0, texture.layers - 1) for texture in self.planes]
+        yield f"vec4 {self.name}Color(vec2 stuv) {{"
+        if (not self.yuv):
+            yield f"    return texture({names[0]}, stuv);"
+        else:
+            yield f"    float y = 1.1644*(texture({names[0]}, stuv).r - 16.0/255.0);"
+            yield f"    float u = (texture({names[1]}, stuv).r - 0.5);"
+            yield f"    float v = (texture({names[2]}, stuv).r - 0.5);"
+            yield "    return vec4(clamp(vec3(y + 1.7927*v, y - 0.2132*u - 0.5329*v, y + 2.1124*u), 0.0, 1.0), 1.0);"
+        yield "}"
 
-        # Only write a new frame when due
-        if self.scene.time > (self._frames / self.fps):
-            frame = next(self._reader)
-            frame = np.flip(frame, axis=0)
-            frame = np.copy(frame, order='C')
-            self.texture.roll()
-            self.texture.write(frame)
-            self._frames += 1
+    def destroy(self) -> None:
+        self._decoder.log_stats()
+        self._decoder.close()
@@ -0,0 +1,108 @@
+import math
+from copy import deepcopy
+
+import numpy as np
+import pytest
+
+from shaderflow.dynamics import DynamicNumber
+
+# ---------------------------------------------------------------------------- #
+
+def reference(system: DynamicNumber, state: dict, target, dt: float) -> None:
+    """The original generic formula with temporary arrays, stepping a copy of a system's state"""
+    if (target is not None):
+        state["target"] = np.array(target, dtype=system.dtype)
+
+    if (np.abs(state["target"] - state["value"]).max() < system.precision):
+        if (system.integrate):
+            state["integral"] += (state["value"] * dt)
+        return
+
+    velocity = (state["target"] - state["previous"])/dt
+    state["previous"] = state["target"]
+
+    if (system.radians*dt < system.zeta):
+        k1 = system.k1
+        k2 = max(k1*dt, system.k2, 0.5*(k1+dt)*dt)
+    else:
+        t1 = math.exp(-1 * system.zeta * system.radians * dt)
+        a1 = 2 * t1 * (math.cos if system.zeta <= 1 else math.cosh)(system.damping*dt)
+        t2 = 1/(1 + t1*t1 - a1) * dt
+        k1 = t2 * (1 - t1*t1)
+        k2 = t2 * dt
+
+    state["value"]       += (state["derivative"] * dt)
+    state["acceleration"] = (state["target"] + system.k3*velocity - state["value"] - k1*state["derivative"])/k2
+    state["derivative"]  += (state["acceleration"] * dt)
+    if (system.integrate):
+        state["integral"] += (state["value"] * dt)
+
+def snapshot(system: DynamicNumber) -> dict:
+    return {name: deepcopy(np.asarray(getattr(system, name))) for name in (
+        "value", "target", "previous", "derivative", "acceleration", "integral",
+    )}
+
+# ---------------------------------------------------------------------------- #
+
+PARAMETERS = (
+    dict(frequency=3.0, zeta=1.0, response=0.0, integrate=False),
+    dict(frequency=3.0, zeta=0.5, response=1.0, integrate=True),
+    dict(frequency=8.0, zeta=0.2, response=-0.5, integrate=True),
+    dict(frequency=40., zeta=2.0, response=2.0, integrate=False),
+)
+
+SHAPES = (
+    ((), np.float64),
+    ((), np.float32),
+    ((3,), np.float64),
+    ((2, 500), np.float32),
+)
+
+@pytest.mark.parametrize("parameters", PARAMETERS)
+@pytest.mark.parametrize("shape,dtype", SHAPES)
+def test_matches_reference(shape, dtype, parameters):
+    """Both the in-place and scalar paths step exactly like the original formula"""
+    rng = np.random.default_rng(0)
+    system = DynamicNumber(value=np.zeros(shape, dtype), dtype=dtype, **parameters)
+    state = snapshot(system)
+
+    for step in range(300):
+        dt = float(rng.uniform(0.001, 0.05))
+
+        # Hold the target for a while to hit the precision shortcut too
+        target = None if (step % 50 > 40) else rng.standard_normal(shape).astype(dtype)
+        reference(system, state, target, dt)
+        system.next(target=target, dt=dt)
+
+        for name in ("value", "derivative", "integral"):
+            assert np.array_equal(np.asarray(getattr(system, name)), state[name]), (step, name)
+
+@pytest.mark.parametrize("shape,dtype", SHAPES)
+def test_target_reassignment(shape, dtype):
+    """Assigning `.target` directly between steps is the same as passing it to next()"""
+    rng = np.random.default_rng(1)
+    direct = DynamicNumber(value=np.zeros(shape, dtype), dtype=dtype, frequency=4, zeta=0.7, response=0.5)
+    passed = DynamicNumber(value=np.zeros(shape, dtype), dtype=dtype, frequency=4, zeta=0.7, response=0.5)
+    state = snapshot(passed)
+
+    for step in range(200):
+        dt = float(rng.uniform(0.001, 0.05))
+        target = rng.standard_normal(shape).astype(dtype)
+        direct.target = target
+        direct.next(dt=dt)
+        passed.next(target=target, dt=dt)
+        reference(passed, state, target, dt)
+
+        for name in ("value", "derivative"):
+            assert np.array_equal(np.asarray(getattr(direct, name)), state[name]), (step, name)
+            assert np.array_equal(np.asarray(getattr(passed, name)), state[name]), (step, name)
+
+def test_shape_change():
+    """A target of a new shape restarts the system on it"""
+    system = DynamicNumber(value=0.0, frequency=4)
+    system.next(target=1.0, dt=0.01)
+    system.next(target=np.ones(4), dt=0.01)
+    assert system.value.shape == (4,)
+    for _ in range(2):
+        system.next(target=np.zeros(4), dt=0.01)
+    assert np.all(system.value < 1.0)
@@ -0,0 +1,106 @@
+import os
+import tempfile
+from pathlib import Path
+from threading import Event, Thread
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from shaderflow.ffmpeg import FFmpeg
+from shaderflow.piano.module import ShaderPiano
+from shaderflow.piano.notes import PianoNotes
+
+# ---------------------------------------------------------------------------- #
+
+def standin(runtime: float=1.5) -> SimpleNamespace:
+    """The attributes of a ShaderPiano the offline synthesis uses, without a scene"""
+    store = PianoNotes()
+    store.extend(
+        start=np.array([0.50, 1.0, 1.2]),
+        end=np.array([1.50, 1.3, 2.0]),
+        note=np.array([60, 60, 61]),
+        channel=np.zeros(3),
+        velocity=np.array([100, 80, 127]),
+    )
+    piano = SimpleNamespace(
+        store=store,
+        samplerate=8000,
+        block=1024,
+        time_offset=0.0,
+        soundfont_file=Path(tempfile.gettempdir())/"missing.sf2",
+        scene=SimpleNamespace(speed=1.0, runtime=runtime),
+        _programs=dict(),
+        _synthesis=None,
+        _synthesizer=None,
+        _cancel=Event(),
+    )
+    piano._events = (lambda total: ShaderPiano._events(piano, total))
+    piano._synthesize = (lambda *args: ShaderPiano._synthesize(piano, *args))
+    return piano
+
+def synthesize(piano: SimpleNamespace, total: int) -> Path:
+    """Start streaming the synthesis into a new named pipe, as ffhook does"""
+    piano._synthesis = Path(tempfile.mkdtemp(prefix="shaderflow-piano-"))
+    piano._cancel = Event()
+    os.mkfifo(path := piano._synthesis/"audio.pcm")
+    piano._synthesizer = Thread(target=piano._synthesize, args=(path, total, piano._cancel), daemon=True)
+    piano._synthesizer.start()
+    return path
+
+# ---------------------------------------------------------------------------- #
+
+def test_mix_command():
+    """Audio files and the synthesized PCM are mixed, not one picked by FFmpeg"""
+    ffmpeg = FFmpeg().pipe_input().input(path="audio.ogg").pcm_input(path="piano.pcm").output(path="video.mp4")
+    ffmpeg.mix = True
+    command = ffmpeg.command
+    assert "[1:a][2:a]amix=inputs=2:duration=longest:normalize=0[mix]" in command
+    assert ("-map", "0:v") in zip(command, command[1:])
+    assert ("-map", "[mix]") in zip(command, command[1:])
+
+    # A single audio input needs no mixing
+    ffmpeg = FFmpeg().pipe_input().pcm_input(path="piano.pcm").output(path="video.mp4")
+    ffmpeg.mix = True
+    assert "-filter_complex" not in ffmpeg.command
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="Named pipes unavailable")
+class TestSynthesis:
+
+    @pytest.fixture(autouse=True)
+    def fluidsynth(self):
+        pytest.importorskip("fluidsynth")
+
+    def test_pipe(self):
+        """The whole duration is streamed through the named pipe, then torn down"""
+        piano = standin()
+        total = round(piano.scene.runtime * piano.samplerate)
+        path  = synthesize(piano, total)
+        data  = path.read_bytes()
+        piano._synthesizer.join(timeout=5)
+        assert len(data) == (total * 2 * 2)
+
+        directory = piano._synthesis
+        ShaderPiano.stop_synthesis(piano)
+        assert not directory.exists()
+        assert piano._synthesis is None
+
+    def test_unread_teardown(self):
+        """A pipe FFmpeg never opened doesn't hang the next export"""
+        piano = standin(runtime=60)
+        synthesize(piano, round(piano.scene.runtime * piano.samplerate))
+        thread, directory = (piano._synthesizer, piano._synthesis)
+        ShaderPiano.stop_synthesis(piano)
+        assert not thread.is_alive()
+        assert not directory.exists()
+
+    def test_abandoned_teardown(self):
+        """A reader leaving early stops the writer"""
+        piano = standin(runtime=60)
+        path = synthesize(piano, round(piano.scene.runtime * piano.samplerate))
+        with open(path, "rb") as file:
+            file.read(1024)
+        thread, directory = (piano._synthesizer, piano._synthesis)
+        ShaderPiano.stop_synthesis(piano)
+        assert not thread.is_alive()
+        assert not directory.exists()